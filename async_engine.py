@@ -0,0 +1,91 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dispatcher import get_dispatcher
+from scheduler import create_schedule
+from utils import create_logger, get_region, get_sensor_id
+
+
+class MonitorTarget(object):
+    def __init__(self, protocol, monitor, pause):
+        self.protocol = protocol
+        self.monitor = monitor
+        self.pause = pause
+
+    def __repr__(self):
+        return "MonitorTarget(protocol=%s, monitor=%s, pause=%s)" % (self.protocol, self.monitor.prefix, self.pause)
+
+
+class AsyncEngine(object):
+    """ Host every monitor as a coroutine of a single event loop.
+
+    The monitors themselves are mostly blocking (dnspython, requests, whois21), so
+    each check is run in a shared thread pool, except for the fetch of the monitors
+    with an async fetcher (the native WHOIS client) which is awaited on the event
+    loop. The per-protocol semaphores bound
+    how many checks of a given kind are in flight at the same time. Each target
+    wakes up on its own drift-free schedule, spread across its interval.
+    """
+    DEFAULT_CONCURRENCY = {'whois': 10, 'dns': 100, 'http': 50}
+
+    def __init__(self, slack_webhook_url=None, concurrency=None):
+        self.slack_webhook_url = slack_webhook_url
+        self.concurrency = dict(self.DEFAULT_CONCURRENCY)
+        if concurrency:
+            self.concurrency.update({k: v for k, v in concurrency.items() if v})
+        self.targets = []
+        self.prefix = f"[sensorid={get_sensor_id()}][mod={self.__class__.__name__}][geo={get_region()}]"
+        self.logger = create_logger(self.prefix)
+
+    def add(self, protocol, monitor, pause):
+        if protocol not in self.concurrency:
+            raise ValueError(f"unknown protocol {protocol}")
+        target = MonitorTarget(protocol, monitor, pause)
+        self.targets.append(target)
+        return target
+
+    async def _run_target(self, target, semaphore, executor):
+        loop = asyncio.get_running_loop()
+        schedule = create_schedule(target.pause, target.monitor.redis_key)
+        triggered = asyncio.Event()
+        target.monitor.on_trigger = lambda: loop.call_soon_threadsafe(triggered.set)
+        while True:
+            target.monitor.schedule_next(schedule, target.pause)
+            try:
+                await asyncio.wait_for(triggered.wait(), schedule.delay())
+            except asyncio.TimeoutError:
+                pass
+            triggered.clear()
+            async with semaphore:
+                await target.monitor.async_check(executor)
+
+    async def run(self):
+        protocols = set(t.protocol for t in self.targets)
+        workers = min(sum(self.concurrency[p] for p in protocols), len(self.targets)) or 1
+        semaphores = {k: asyncio.Semaphore(v) for k, v in self.concurrency.items()}
+        dns_targets = [t for t in self.targets if t.protocol == 'dns']
+        if dns_targets:
+            # every DNS check in flight can have all its queries running
+            from dns_monitor import size_resolve_executor
+            width = max(getattr(t.monitor, 'resolve_width', 1) for t in dns_targets)
+            size_resolve_executor(min(self.concurrency['dns'], len(dns_targets)) * width)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="monitor") as executor:
+            tasks = [asyncio.create_task(self._run_target(t, semaphores[t.protocol], executor))
+                     for t in self.targets]
+            await asyncio.gather(*tasks)
+
+    def notify(self, message):
+        get_dispatcher().notify(self.slack_webhook_url, self.prefix, message)
+
+    def serve_forever(self):
+        if not self.targets:
+            self.logger.error("no target to monitor")
+            return 1
+        self.logger.info(f"starting {len(self.targets)} targets with concurrency {self.concurrency}")
+        self.notify(f":alert: *{self.prefix}*\nprocess started with {len(self.targets)} targets")
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            self.notify(f":alert: *{self.prefix}*\nprocess interrupted, exiting...")
+        self.notify(f":alert: *{self.prefix}*\nprocess stopped")
+        get_dispatcher().close()
+        return 0
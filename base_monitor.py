@@ -1,11 +1,21 @@
 import traceback
 import time
+import asyncio
+import threading
 import json
 import hashlib
 import argparse
-from utils import slack, create_logger, create_redis_client, get_region, get_sensor_id
+from utils import create_logger, create_redis_client, get_region, get_sensor_id
+from record_diff import Change, diff_records
+from history import create_change_history
+from dispatcher import get_dispatcher
+from consensus import create_consensus
+from scheduler import create_schedule
+from metrics import CHECKS, CHANGES, SKIPPED, IN_FLIGHT, FETCH_SECONDS, DIFF_SECONDS, REDIS_SECONDS, start_metrics_server
 
 class BaseMonitor:
+    REDIS_TTL = 86400
+
     def __init__(self, slack_webhook_url=None, **kwargs):
         self.class_name = self.__class__.__name__
         self.sensor_id = get_sensor_id()
@@ -13,11 +23,20 @@ class BaseMonitor:
         self.slack_webhook_url = slack_webhook_url
         self.redis_client = create_redis_client()
         self.redis_key = self._generate_redis_key(kwargs)
+        self.digest_key = f"{self.redis_key}:digest"
+        self.history = create_change_history(self.redis_client, f"{self.redis_key}:history")
         self.prefix = f"[sensorid={self.sensor_id}][mod={self.class_name}][geo={self.region}]"
         self.parameters = kwargs.copy()
         for k, v in self.parameters.items():
             self.prefix += f"[{k}={v}]"
+        self.target = ",".join(f"{k}={v}" for k, v in self.parameters.items())
+        self.metric_labels = {'monitor': self.class_name, 'target': self.target, 'sensor': self.sensor_id, 'region': self.region}
         self.logger = create_logger(self.prefix)
+        self.consensus = create_consensus(self)
+        self.last_digest = None
+        self.last_fetched_records = None
+        self.triggered = threading.Event()
+        self.on_trigger = None
         self.logger.debug(f"initialized with parameters: {self.parameters}")
         self.logger.debug(f"initialized with redis key: {self.redis_key}")
 
@@ -33,8 +52,16 @@ class BaseMonitor:
     def fetch_new_records(self):
         raise NotImplementedError()
 
-    def _fetch_new_records(self):
-        records = self.fetch_new_records()
+    def async_fetcher(self):
+        """ Coroutine function fetching the records on the event loop of the async engine,
+        None when the records are fetched by fetch_new_records in a thread """
+        return None
+
+    def _fetch_new_records(self, records=None):
+        """ Fetch the records unless given, each value a list """
+        if records is None:
+            with FETCH_SECONDS.time(**self.metric_labels):
+                records = self.fetch_new_records()
         new_records = {}
         for k, v in records.items():
             if not isinstance(v, list):
@@ -43,106 +70,240 @@ class BaseMonitor:
                 new_records[k] = v
         return new_records
 
-    def store_records_in_redis(self, records):
-        self.redis_client.set(self.redis_key, json.dumps(records))
-        self.redis_client.expire(self.redis_key, 86400)
+    @staticmethod
+    def records_digest(records):
+        """ Digest of the records, independent of the order of keys and values """
+        canonical = {k: sorted(v, key=lambda x: json.dumps(x, sort_keys=True)) for k, v in records.items()}
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+    def store_records_in_redis(self, records, pipe=None, digest=None):
+        """ Store the records along with their digest """
+        if digest is None:
+            digest = self.records_digest(records)
+        client = pipe if pipe is not None else self.redis_client.pipeline(transaction=False)
+        client.set(self.redis_key, json.dumps(records), ex=self.REDIS_TTL)
+        client.set(self.digest_key, digest, ex=self.REDIS_TTL)
+        if pipe is None:
+            client.execute()
 
-    def refresh_ttl(self):
+    def refresh_ttl(self, pipe=None):
+        if pipe is not None:
+            pipe.expire(self.redis_key, self.REDIS_TTL)
+            pipe.expire(self.digest_key, self.REDIS_TTL)
+            return
         try:
-            self.redis_client.expire(self.redis_key, 86400)
+            pipe = self.redis_client.pipeline(transaction=False)
+            self.refresh_ttl(pipe=pipe)
+            pipe.execute()
         except Exception as e:
             self.logger.warning(f"could not refresh Redis TTL: {e}", exc_info=True)
 
+    def queue_get_cached_digest(self, pipe):
+        """ Queue the read of the cached digest on a pipeline, refreshing the TTL of the digest and records.
+        Return the index of the digest in the results of the pipeline """
+        index = len(pipe)
+        pipe.get(self.digest_key)
+        self.refresh_ttl(pipe=pipe)
+        return index
+
+    def get_cached_digest(self):
+        """ Read the cached digest and refresh the TTLs in a single round trip """
+        pipe = self.redis_client.pipeline(transaction=False)
+        index = self.queue_get_cached_digest(pipe)
+        digest = pipe.execute()[index]
+        return digest.decode() if digest else None
+
+    def queue_get_cached_records(self, pipe):
+        """ Queue the read of the cached records on a pipeline, refreshing their TTL at the same time.
+        Return the index of the records in the results of the pipeline """
+        index = len(pipe)
+        pipe.get(self.redis_key)
+        pipe.expire(self.redis_key, self.REDIS_TTL)
+        return index
+
     def get_cached_records(self):
-        return self.redis_client.get(self.redis_key)
+        """ Read the cached records and refresh their TTL in a single round trip """
+        pipe = self.redis_client.pipeline(transaction=False)
+        index = self.queue_get_cached_records(pipe)
+        return pipe.execute()[index]
 
-    def detect_changes(self):
-        new_records = self._fetch_new_records()
-        self.logger.info(f"found new records: {json.dumps(new_records)}")
-        changed = False
-        changes = set()
-        cached_records = self.get_cached_records()
-        if not cached_records:
+    def compare_records(self, cached_records, new_records):
+        """ Compare decoded cached records (None if not cached yet) with new records """
+        if cached_records is None:
             msg = "records are not cached yet, nothing to compare with."
             self.logger.info(msg)
-            for k, v in new_records.items():
-                changes.add(f"{k}: {v}")
-            changes = list(changes)
-            self.logger.debug(f"caching records")
-            self.store_records_in_redis(new_records)
-            return changed, msg, list(changes)
-
-        cached_records = json.loads(cached_records)
+            return False, msg, diff_records({}, new_records)
+
         self.logger.debug(f"cached records: {cached_records}")
         self.logger.debug(f"new records: {new_records}")
-        for k, v in cached_records.items():
-            if k not in new_records:
-                self.logger.info(f"{k} -> record deleted: {v} -> (not present)")
-                changes.add(f"{k} -> record deleted: {v} -> (not present)")
-            elif k in new_records and sorted(new_records[k]) != sorted(v):
-                self.logger.info(f"{k} -> record changed: {v} -> {new_records[k]}")
-                changes.add(f"{k} -> record changed: {v} -> {new_records[k]}")
-        for k, v in new_records.items():
-            if k not in cached_records:
-                self.logger.info(f"{k} -> record added: (not present) -> {v}")
-                changes.add(f"{k} -> record added: (not present) -> {v}")
-            elif k in cached_records and sorted(cached_records[k]) != sorted(v):
-                self.logger.info(f"{k} -> record changed: {cached_records[k]} -> {v}")
-                changes.add(f"{k} -> record changed: {cached_records[k]} -> {v}")
+        changes = diff_records(cached_records, new_records)
+        for change in changes:
+            self.logger.info(f"{change}")
         if len(changes) > 0:
             msg = "records changed"
             changed = True
-            self.logger.info(msg)
-            self.logger.debug(f"caching new records")
-            self.store_records_in_redis(new_records)
         else:
             msg = "records not changed"
             changed = False
+        self.logger.info(msg)
+        return changed, msg, changes
+
+    def detect_changes(self, records=None):
+        """ Compare records, fetched now unless given, with the cached ones """
+        new_records = self._fetch_new_records(records)
+        self.logger.info(f"found new records: {json.dumps(new_records)}")
+        digest = self.records_digest(new_records)
+        self.last_digest = digest
+        self.last_fetched_records = new_records
+        with REDIS_SECONDS.time(operation='get_digest', **self.metric_labels):
+            cached_digest = self.get_cached_digest()
+        if cached_digest == digest:
+            # steady state: same content, no need to load and compare the cached records
+            msg = "records not changed"
             self.logger.info(msg)
-            self.refresh_ttl()
-        return changed, msg, list(changes)
+            return False, msg, []
+        with REDIS_SECONDS.time(operation='get_records', **self.metric_labels):
+            cached_records = self.get_cached_records()
+        with DIFF_SECONDS.time(**self.metric_labels):
+            if cached_records:
+                cached_records = json.loads(cached_records)
+            else:
+                cached_records = None
+            changed, msg, changes = self.compare_records(cached_records, new_records)
+        if changed:
+            CHANGES.inc(len(changes), **self.metric_labels)
+        # also rewritten when only the digest is missing or stale
+        self.logger.debug(f"caching new records")
+        with REDIS_SECONDS.time(operation='store', **self.metric_labels):
+            pipe = self.redis_client.pipeline(transaction=False)
+            self.store_records_in_redis(new_records, pipe=pipe, digest=digest)
+            if cached_records is None or changed:
+                self.history.append(changes, new_records, pipe=pipe)
+            pipe.execute()
+        return changed, msg, changes
 
-    def monitor(self):
-        """ Monitor records and send slack notifications if changes are detected """
-        self.logger.info(f"monitoring started")
-        changed, msg, changed_data = self.detect_changes()
+    @staticmethod
+    def format_change(change):
+        """ One diff-like line per change: `+` added, `-` removed, `~` modified """
+        if change.kind == Change.ADDED:
+            return f"+ {change.key}: {change.new}"
+        if change.kind == Change.REMOVED:
+            return f"- {change.key}: {change.old}"
+        return f"~ {change.key}: {change.old} -> {change.new}"
+
+    def report(self, changed, msg, changed_data):
+        """ Send slack notifications if changes are detected """
         if changed_data and len(changed_data) > 0:
             if self.slack_webhook_url:
                 if changed is True: emoji = ":warning:"
                 else: emoji = ":information_source:"
                 slack_message = f"{emoji} *{self.prefix}*\n{msg}\n"
                 slack_message += '```'
-                for data in changed_data:
-                    slack_message += f"- {data}\n"
+                for change in changed_data:
+                    slack_message += f"{self.format_change(change)}\n"
                 slack_message += '```'
-                slack(slack_message, self.slack_webhook_url)
+                self.notify(slack_message)
         elif changed is True and len(changed_data) == 0:
             if self.slack_webhook_url:
                 slack_message = f":warning: *{self.prefix}*\n{msg}\n"
-                slack(slack_message, self.slack_webhook_url)
+                self.notify(slack_message)
         else:
             self.logger.debug("no changes")
+
+    def monitor(self, records=None):
+        """ Monitor records and send slack notifications if changes are detected """
+        self.logger.info(f"monitoring started")
+        changed, msg, changed_data = self.detect_changes(records)
+        if self.consensus:
+            # alerted once for all the sensors when enough regions agree
+            self.consensus.observe(self.last_digest, self.last_fetched_records, changed, changed_data)
+        else:
+            self.report(changed, msg, changed_data)
         self.logger.info(f"monitoring completed")
 
-    def serve_forever(self, pause=60):
+    def notify(self, message):
+        """ Queue a slack notification, sent in the background by the dispatcher """
+        get_dispatcher().notify(self.slack_webhook_url, self.prefix, message)
+
+    def notify_started(self):
         slack_message = f":alert: *{self.prefix}*\nprocess started"
-        slack(slack_message, self.slack_webhook_url)
+        self.notify(slack_message)
+
+    def notify_interrupted(self):
+        slack_message = f":alert: *{self.prefix}*\nprocess interrupted, exiting..."
+        self.notify(slack_message)
+
+    def notify_stopped(self):
+        slack_message = f":alert: *{self.prefix}*\nprocess stopped"
+        self.notify(slack_message)
+
+    def check(self, records=None):
+        """ Run a single monitoring cycle, reporting errors instead of raising them """
+        try:
+            with IN_FLIGHT.track(monitor=self.class_name, sensor=self.sensor_id, region=self.region):
+                self.monitor(records)
+            CHECKS.inc(result='ok', **self.metric_labels)
+            return True
+        except Exception as e:
+            return self.check_failed(e)
+
+    def check_failed(self, e):
+        """ Report the exception being handled, return False """
+        CHECKS.inc(result='error', **self.metric_labels)
+        self.logger.error(f"{e}", exc_info=True)
+        slack_message = f":ouch: *{self.prefix}*\nerror: {e}"
+        slack_message += f"\n```{traceback.format_exc()}```"
+        self.notify(slack_message)
+        return False
+
+    async def async_check(self, executor):
+        """ check() from the async engine: the records are fetched on its event loop when the
+        monitor has an async fetcher, the rest of the check is run in executor """
+        loop = asyncio.get_running_loop()
+        fetch = self.async_fetcher()
+        records = None
+        if fetch is not None:
+            try:
+                with IN_FLIGHT.track(monitor=self.class_name, sensor=self.sensor_id, region=self.region), \
+                        FETCH_SECONDS.time(**self.metric_labels):
+                    records = await fetch()
+            except Exception as e:
+                return self.check_failed(e)
+        return await loop.run_in_executor(executor, self.check, records)
+
+    def next_interval(self, pause):
+        """ Seconds until the next check, monitors may adapt it to what they observed """
+        return pause
+
+    def trigger(self):
+        """ Run the next check right away instead of at its deadline, from any thread """
+        self.triggered.set()
+        if self.on_trigger:
+            self.on_trigger()
+
+    def schedule_next(self, schedule, pause):
+        """ Advance schedule to the next check, reporting the cycles skipped by an overrun """
+        skipped = schedule.advance(self.next_interval(pause))
+        if skipped:
+            SKIPPED.inc(skipped, **self.metric_labels)
+            self.logger.warning(f"check overran its {schedule.interval:g} seconds interval, skipped {skipped} cycle(s)")
+        return skipped
+
+    def serve_forever(self, pause=60):
+        self.notify_started()
+        schedule = create_schedule(pause, self.redis_key)
         while True:
             try:
-                self.monitor()
-                time.sleep(pause)
+                self.schedule_next(schedule, pause)
+                if self.triggered.wait(schedule.delay()):
+                    self.logger.info("check triggered")
+                self.triggered.clear()
+                self.check()
             except KeyboardInterrupt:
-                slack_message = f":alert: *{self.prefix}*\nprocess interrupted, exiting..."
-                slack(slack_message, self.slack_webhook_url)
+                self.notify_interrupted()
                 break
-            except Exception as e:
-                self.logger.error(f"{e}", exc_info=True)
-                slack_message = f":ouch: *{self.prefix}*\nerror: {e}"
-                slack_message += f"\n```{traceback.format_exc()}```"
-                slack(slack_message, self.slack_webhook_url)
-                time.sleep(pause)
-        slack_message = f":alert: *{self.prefix}*\nprocess stopped"
-        slack(slack_message, self.slack_webhook_url)
+        self.notify_stopped()
+        get_dispatcher().close()
 
 
 class MonitorFactory(object):
@@ -153,13 +314,19 @@ class MonitorFactory(object):
         self.name = self.monitor_class.__name__
         self.parser = argparse.ArgumentParser(description=self.name)
 
+    def start_metrics_server(self):
+        if getattr(self.args, 'metrics_port', None):
+            start_metrics_server(self.args.metrics_port)
+
     def serve_forever(self):
         self.parser.add_argument("--slack_webhook_url", help="slack webhook url (default disabled)", default=None)
         self.parser.add_argument("--pause", help="pause time in seconds (default 60) between each check", type=int, default=60)
+        self.parser.add_argument("--metrics_port", type=int, help="serve Prometheus metrics on this port (default disabled)", default=None)
         self.args = self.parser.parse_args()
         self.slack_webhook_url = self.args.slack_webhook_url
         self.pause = self.args.pause
         self.monitor = self.monitor_class(self.slack_webhook_url, **self.kwargs)
+        self.start_metrics_server()
         self.monitor.serve_forever(pause=self.pause)
         return self.monitor
 
@@ -0,0 +1,198 @@
+""" Benchmark the monitors against the bundled test servers.
+
+Starts the DNS, WHOIS and HTTP test servers on ephemeral ports, drives N targets
+of each monitor type through a number of check cycles and writes the results as
+JSON, so that runs of different versions can be compared.
+"""
+import os
+import sys
+import time
+import json
+import shlex
+import socket
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# monitors log every check, keep the benchmark output readable
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+# measure the monitors, not the per-server WHOIS rate limit
+os.environ.setdefault("WHOIS_QPS", "100000")
+os.environ.setdefault("WHOIS_BURST", "100000")
+
+from utils import create_redis_client
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def start_server(script, args):
+    cmd = [sys.executable, os.path.join(ROOT, script)] + args
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def rss_kb():
+    """ Resident set size of this process in kB """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def redis_commands(redis_client):
+    return int(redis_client.info('stats')['total_commands_processed'])
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def timed_check(monitor):
+    started = time.perf_counter()
+    ok = monitor.check()
+    return time.perf_counter() - started, ok
+
+
+def build_monitors(kind, count, ports):
+    monitors = []
+    if kind == 'dns':
+        from dns_monitor import DNSRecordMonitor
+        for i in range(count):
+            monitors.append(DNSRecordMonitor(f"bench{i}.dummy.net", '127.0.0.1', port=ports['dns']))
+    elif kind == 'whois':
+        from whois_monitor import WHOISMonitor
+        for i in range(count):
+            monitors.append(WHOISMonitor(f"bench{i}.dummy.net", whois_server=f"127.0.0.1:{ports['whois']}",
+                                         whois_timeout=10))
+    elif kind == 'http':
+        from http_monitor import HTTPMonitor
+        for i in range(count):
+            monitors.append(HTTPMonitor(f"http://127.0.0.1:{ports['http']}/bench{i}", timeout=10))
+    return monitors
+
+
+def run(kind, count, cycles, concurrency, ports, redis_client):
+    rss_before = rss_kb()
+    monitors = build_monitors(kind, count, ports)
+    latencies = []
+    errors = 0
+    commands_before = redis_commands(redis_client)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for cycle in range(cycles):
+            for latency, ok in executor.map(timed_check, monitors):
+                latencies.append(latency)
+                errors += 0 if ok else 1
+    elapsed = time.perf_counter() - started
+    # the INFO call itself is counted by Redis
+    commands = redis_commands(redis_client) - commands_before - 1
+    checks = len(latencies)
+    return {
+        'targets': count,
+        'cycles': cycles,
+        'checks': checks,
+        'errors': errors,
+        'elapsed_seconds': elapsed,
+        'checks_per_second': checks / elapsed if elapsed else None,
+        'latency_p50_seconds': percentile(latencies, 50),
+        'latency_p95_seconds': percentile(latencies, 95),
+        'latency_p99_seconds': percentile(latencies, 99),
+        'rss_per_target_kb': (rss_kb() - rss_before) / count if count else None,
+        'redis_ops_per_check': commands / checks if checks else None,
+    }
+
+
+def compare(results, baseline):
+    """ Print the relative change of each metric against a previous results file """
+    print(f"compared with {baseline.get('version')}:")
+    for kind, metrics in results['results'].items():
+        previous = baseline.get('results', {}).get(kind)
+        if not previous:
+            continue
+        for name, value in metrics.items():
+            old = previous.get(name)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                print(f"  {kind}.{name}: {old:.4g} -> {value:.4g} ({(value - old) / old * 100:+.1f}%)")
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the monitors against the bundled test servers")
+    parser.add_argument('--types', type=str, default='dns,http,whois', help='Monitor types to benchmark (default dns,http,whois)')
+    parser.add_argument('--targets', type=int, default=100, help='Targets per monitor type (default 100)')
+    parser.add_argument('--cycles', type=int, default=5, help='Check cycles per target (default 5)')
+    parser.add_argument('--concurrency', type=int, default=20, help='Checks running at the same time (default 20)')
+    parser.add_argument('--server_args', type=str, default='', help='Extra arguments of the test servers, e.g. "--latency 0.05 --error_rate 0.01 --seed 1"')
+    parser.add_argument('--output', type=str, default='bench_results.json', help='Results file (default bench_results.json)')
+    parser.add_argument('--baseline', type=str, default=None, help='Previous results file to compare with')
+    args = parser.parse_args()
+
+    kinds = [k.strip() for k in args.types.split(',') if k.strip()]
+    ports = {'dns': free_port(socket.SOCK_DGRAM), 'http': free_port(), 'whois': free_port()}
+    server_args = shlex.split(args.server_args)
+    servers = []
+    try:
+        if 'dns' in kinds:
+            servers.append(start_server('dns_test_server.py', ['--port', str(ports['dns'])] + server_args))
+            # UDP only, give it time to bind
+            time.sleep(1)
+        if 'http' in kinds:
+            servers.append(start_server('http_test_server.py', ['--port', str(ports['http']), '--host', '127.0.0.1',
+                                                                 '--keyfile', '', '--certfile', ''] + server_args))
+            wait_for_port(ports['http'])
+        if 'whois' in kinds:
+            servers.append(start_server('whois_test_server.py', ['--port', str(ports['whois'])] + server_args))
+            wait_for_port(ports['whois'])
+
+        redis_client = create_redis_client()
+        results = {'version': git_version(), 'timestamp': time.time(), 'parameters': vars(args), 'results': {}}
+        for kind in kinds:
+            print(f"benchmarking {kind}: {args.targets} targets x {args.cycles} cycles")
+            results['results'][kind] = run(kind, args.targets, args.cycles, args.concurrency, ports, redis_client)
+            print(json.dumps(results['results'][kind], indent=2))
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+        if args.baseline:
+            with open(args.baseline) as f:
+                compare(results, json.load(f))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
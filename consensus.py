@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import redis
+from dispatcher import get_dispatcher
+from record_diff import Change, apply_changes, diff_records
+
+# field of the hash holding the digest last confirmed by the quorum, and how many were confirmed before it
+CONFIRMED = '_confirmed'
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_consensus_redis():
+    """ Return the client of the Redis shared by all the sensors, None when CONSENSUS_REDIS_URL is not set """
+    global _client
+    url = os.getenv("CONSENSUS_REDIS_URL")
+    if not url:
+        return None
+    with _client_lock:
+        if _client is None:
+            _client = redis.Redis.from_url(url)
+        return _client
+
+
+class Consensus(object):
+    """ Confirm the changes of a target across sensors before alerting.
+
+    Each sensor publishes the digest of its records to the shared hash
+    `consensus:<target id>`, one field per region as given by get_region(), so
+    the sensors of a region share a single vote. A change is alerted once at least `quorum` regions
+    observe the same digest. The confirmed digest then moves forward and the
+    sensors claim the alert of that transition with SET NX, so a change
+    produces one alert whatever the number of sensors. A change seen by fewer
+    regions, e.g. a regional glitch, is never alerted, nor is the return to
+    the confirmed records once the glitch is over.
+    """
+    def __init__(self, monitor, redis_client, quorum=2, window=600, max_age=3600):
+        self.monitor = monitor
+        self.redis_client = redis_client
+        self.quorum = quorum
+        self.window = window
+        self.max_age = max_age
+        self.observer = monitor.region
+        self.target_id = self.get_target_id(monitor)
+        self.key = f"consensus:{self.target_id}"
+        self.prefix = f"[consensus][mod={monitor.class_name}]" + "".join(f"[{k}={v}]" for k, v in monitor.parameters.items())
+        self.published = None
+        self.published_at = 0
+        self.pending = None
+        self.observers_checked = False
+
+    @staticmethod
+    def get_target_id(monitor):
+        """ Same id for the same target on every sensor """
+        params = json.dumps(monitor.parameters, sort_keys=True)
+        return f"{monitor.class_name}:{hashlib.sha256(params.encode()).hexdigest()}"
+
+    def observations(self, values):
+        """ Decode the hash into {observer: digest}, without the observations older than max_age """
+        now = time.time()
+        observations = {}
+        for observer, value in values.items():
+            if observer in (CONFIRMED, CONFIRMED.encode()):
+                continue
+            value = json.loads(value)
+            if now - value['time'] <= self.max_age:
+                observations[observer.decode() if isinstance(observer, bytes) else observer] = value['digest']
+        return observations
+
+    @staticmethod
+    def revert(records, changes):
+        """ Records before changes were applied to records """
+        inverse = [Change(Change.ADDED if c.kind == Change.REMOVED else Change.REMOVED if c.kind == Change.ADDED else c.kind,
+                          c.key, old=c.new, new=c.old) for c in reversed(changes)]
+        return apply_changes(records, inverse)
+
+    def get_confirmed(self, values):
+        """ (digest, generation) last confirmed by the quorum, (None, 0) if none yet """
+        confirmed = values.get(CONFIRMED) or values.get(CONFIRMED.encode())
+        if not confirmed:
+            return None, 0
+        try:
+            confirmed = json.loads(confirmed)
+        except ValueError:
+            # bare digest written by previous versions
+            return confirmed.decode() if isinstance(confirmed, bytes) else confirmed, 0
+        return confirmed['digest'], confirmed['generation']
+
+    def observe(self, digest, records, changed, changes):
+        """ Publish the digest of the latest records, alert when a pending change reaches the quorum """
+        now = time.time()
+        # published again before it gets too old to count
+        if digest != self.published or now - self.published_at > self.max_age / 2:
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.hset(self.key, self.observer, json.dumps({'digest': digest, 'time': now}))
+            pipe.expire(self.key, self.max_age)
+            pipe.hgetall(self.key)
+            values = pipe.execute()[-1]
+            if digest != self.published and changed:
+                # records before the first change not confirmed yet, the alert lists the changes since
+                if self.pending is None:
+                    self.pending = self.revert(records, changes)
+                if self.monitor.records_digest(self.pending) == digest:
+                    self.pending = None
+            self.published = digest
+            self.published_at = now
+        elif self.pending is not None:
+            values = self.redis_client.hgetall(self.key)
+        else:
+            return False
+        observations = self.observations(values)
+        if not self.observers_checked:
+            self.observers_checked = True
+            if len(observations) < self.quorum:
+                self.monitor.logger.warning(f"only {len(observations)} region(s) observe this target so far ({', '.join(sorted(observations))}) "
+                                            f"for a quorum of {self.quorum}, changes are not alerted until more do. "
+                                            f"Sensors of the same region count as one.")
+        agreeing = sorted(o for o, d in observations.items() if d == digest)
+        if len(agreeing) < self.quorum:
+            if self.pending is not None:
+                self.monitor.logger.info(f"change seen by {len(agreeing)}/{self.quorum} regions needed")
+            return False
+        confirmed, generation = self.get_confirmed(values)
+        if confirmed == digest:
+            if self.pending is not None:
+                # alerted by another sensor, or back to the confirmed records after a change only this region saw
+                self.monitor.logger.info("records match the confirmed records, not alerting")
+                self.pending = None
+            return False
+        if self.pending is None:
+            if confirmed is None:
+                self.redis_client.hsetnx(self.key, CONFIRMED, json.dumps({'digest': digest, 'generation': 0}))
+            return False
+        changes = diff_records(self.pending, records)
+        self.pending = None
+        # the same for every sensor confirming this transition, so it is alerted once
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.set(f"{self.key}:alerted:{generation}:{confirmed}->{digest}", self.observer, nx=True, ex=self.window)
+        pipe.hset(self.key, CONFIRMED, json.dumps({'digest': digest, 'generation': generation + 1}))
+        claimed = pipe.execute()[0]
+        if not claimed:
+            self.monitor.logger.info("change already alerted by another sensor")
+            return False
+        self.alert(digest, observations, changes)
+        return True
+
+    def alert(self, digest, observations, changes):
+        agreeing = [o for o, d in observations.items() if d == digest]
+        message = f":warning: *{self.prefix}*\nrecords changed, confirmed by {len(agreeing)}/{len(observations)} regions\n```"
+        for observer, observed in sorted(observations.items()):
+            message += f"{observer}: {'agrees' if observed == digest else 'differs (' + observed[:12] + ')'}\n"
+        message += "```\n```"
+        for change in changes:
+            message += f"{self.monitor.format_change(change)}\n"
+        message += "```"
+        self.monitor.logger.info(f"change confirmed by {sorted(agreeing)}, alerting")
+        get_dispatcher().notify(self.monitor.slack_webhook_url, self.prefix, message)
+
+
+def create_consensus(monitor):
+    redis_client = get_consensus_redis()
+    if redis_client is None:
+        return None
+    quorum = int(os.getenv("CONSENSUS_QUORUM", 2))
+    window = int(os.getenv("CONSENSUS_WINDOW", 600))
+    max_age = int(os.getenv("CONSENSUS_MAX_AGE", 3600))
+    return Consensus(monitor, redis_client, quorum=quorum, window=window, max_age=max_age)
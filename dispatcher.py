@@ -0,0 +1,247 @@
+import os
+import sys
+import time
+import hashlib
+import json
+import queue
+import itertools
+import collections
+import threading
+import redis
+from utils import slack, create_logger, create_redis_client, get_sensor_id
+from metrics import NOTIFICATION_SECONDS
+
+
+class NotificationDispatcher(object):
+    """ Send Slack notifications from a background thread.
+
+    Notifications are queued without blocking the caller and grouped per webhook and
+    target. The first notification of a target is sent right away, those following
+    it within `window` seconds are sent together as a single message. Rate limited posts
+    (HTTP 429) wait for `Retry-After`, other failures are retried with exponential
+    backoff. Unsent notifications are kept in a Redis list so they survive restarts,
+    written by the background thread: the list is trimmed from its head as the
+    notifications it starts with are sent.
+    """
+    def __init__(self, window=60, maxsize=10000, max_retries=5, timeout=10, redis_client=None, backlog_key=None):
+        self.window = window
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.redis_client = redis_client
+        self.backlog_key = backlog_key
+        self.pending = {}
+        # {(url, target): time of the last message sent}
+        self.sent_at = {}
+        self.ids = itertools.count()
+        # ids of the notifications in the backlog list, in order, and those sent or dropped
+        self.backlog = collections.deque()
+        self.in_backlog = set()
+        self.done = set()
+        self.untrimmed = 0
+        self.retry_at = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.logger = create_logger(f"[sensorid={get_sensor_id()}][mod={self.__class__.__name__}]")
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return self
+            self.thread = threading.Thread(target=self.run, name="notifications", daemon=True)
+            self.thread.start()
+        self.restore()
+        return self
+
+    def restore(self):
+        """ Take over the notifications left unsent by a previous process """
+        if self.redis_client is None:
+            return
+        claim_key = f"{self.backlog_key}:restore:{os.getpid()}"
+        try:
+            self.redis_client.rename(self.backlog_key, claim_key)
+        except redis.exceptions.ResponseError:
+            # no backlog
+            return
+        except Exception as e:
+            self.logger.warning(f"could not restore notifications backlog: {e}")
+            return
+        items = self.redis_client.lrange(claim_key, 0, -1)
+        self.redis_client.delete(claim_key)
+        self.logger.info(f"restoring {len(items)} unsent notifications")
+        for raw in items:
+            item = json.loads(raw)
+            self.notify(item['url'], item['target'], item['message'], created=item['created'])
+
+    def notify(self, slack_webhook_url, target, message, created=None):
+        """ Queue a notification, never blocking the caller """
+        if not slack_webhook_url or not message:
+            return False
+        if self.thread is None:
+            self.start()
+        item = {'url': slack_webhook_url, 'target': target, 'message': message, 'created': created or time.time()}
+        raw = json.dumps(item)
+        try:
+            self.queue.put_nowait(raw)
+        except queue.Full:
+            self.logger.error(f"notification queue is full, dropping notification for {target}")
+            return False
+        return True
+
+    def _collect(self, timeout):
+        try:
+            raw = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        collected = []
+        while raw is not None:
+            item = json.loads(raw)
+            item_id = next(self.ids)
+            key = (item['url'], item['target'])
+            if key not in self.pending:
+                # due right away unless a message was sent for the target within the window
+                due = max(item['created'], self.sent_at.get(key, 0) + self.window)
+                self.pending[key] = {'due': due, 'items': [], 'ids': []}
+            group = self.pending[key]
+            group['items'].append(raw)
+            group['ids'].append(item_id)
+            collected.append((item_id, raw))
+            try:
+                raw = self.queue.get_nowait()
+            except queue.Empty:
+                raw = None
+        self._persist(collected)
+
+    def _persist(self, collected):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.rpush(self.backlog_key, *[raw for _, raw in collected])
+        except Exception as e:
+            self.logger.warning(f"could not persist notifications: {e}")
+            return
+        self.backlog.extend(item_id for item_id, _ in collected)
+        self.in_backlog.update(item_id for item_id, _ in collected)
+
+    @staticmethod
+    def coalesce(items):
+        """ Merge the messages of a group, identical messages are sent once with a counter """
+        counts = {}
+        for raw in items:
+            message = json.loads(raw)['message']
+            counts[message] = counts.get(message, 0) + 1
+        messages = []
+        for message, count in counts.items():
+            if count > 1:
+                message += f"\n(repeated {count} times)"
+            messages.append(message)
+        return "\n".join(messages)
+
+    def _send(self, url, items):
+        """ Post a group of notifications, return False if it should be retried later """
+        started = time.perf_counter()
+        try:
+            res = slack(self.coalesce(items), url, timeout=self.timeout)
+        except Exception as e:
+            NOTIFICATION_SECONDS.observe(time.perf_counter() - started, result='error')
+            self.logger.warning(f"could not send notification: {e}")
+            return False
+        NOTIFICATION_SECONDS.observe(time.perf_counter() - started, result=str(res.status_code))
+        if res.status_code == 429:
+            retry_after = res.headers.get('Retry-After')
+            try:
+                retry_after = float(retry_after)
+            except (TypeError, ValueError):
+                retry_after = self.window
+            self.logger.warning(f"rate limited by slack, retrying in {retry_after} seconds")
+            self.retry_at = max(self.retry_at, time.time() + retry_after)
+            return False
+        if res.status_code >= 500:
+            self.logger.warning(f"could not send notification: HTTP {res.status_code}")
+            return False
+        if res.status_code >= 400:
+            # the message will never be accepted, do not retry it
+            self.logger.error(f"notification rejected: HTTP {res.status_code} {res.text}")
+        return True
+
+    def _forget(self, ids):
+        """ Trim the sent or dropped notifications at the head of the backlog list """
+        if self.redis_client is None:
+            return
+        self.done.update(item_id for item_id in ids if item_id in self.in_backlog)
+        while self.backlog and self.backlog[0] in self.done:
+            item_id = self.backlog.popleft()
+            self.done.discard(item_id)
+            self.in_backlog.discard(item_id)
+            self.untrimmed += 1
+        if not self.untrimmed:
+            return
+        try:
+            self.redis_client.ltrim(self.backlog_key, self.untrimmed, -1)
+            self.untrimmed = 0
+        except Exception as e:
+            self.logger.warning(f"could not remove sent notifications from the backlog: {e}")
+
+    def flush(self, force=False):
+        """ Send the groups that are due (all of them if force) """
+        now = time.time()
+        for key in list(self.pending.keys()):
+            if now < self.retry_at:
+                return
+            group = self.pending[key]
+            if not force and now < group['due']:
+                continue
+            if self._send(key[0], group['items']):
+                self.sent_at[key] = now
+                del self.pending[key]
+                self._forget(group['ids'])
+                continue
+            group['retries'] = group.get('retries', 0) + 1
+            if group['retries'] > self.max_retries:
+                self.logger.error(f"dropping {len(group['items'])} notifications for {key[1]} after {self.max_retries} retries")
+                del self.pending[key]
+                self._forget(group['ids'])
+            else:
+                # exponential backoff
+                group['due'] = now + min(2 ** group['retries'], 300)
+
+    def run(self):
+        while not self.stopping.is_set():
+            self._collect(timeout=1)
+            self.flush()
+
+    def close(self, timeout=10):
+        """ Stop the background thread, trying to send what is pending for up to timeout seconds """
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            # still sending, what is left stays in the backlog for the next start
+            self.logger.warning("notification thread did not stop in time")
+            return
+        deadline = time.time() + timeout
+        self._collect(timeout=0)
+        while self.pending and time.time() < deadline:
+            self.flush(force=True)
+            if self.pending:
+                time.sleep(1)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    """ Return the process-wide notification dispatcher """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            # at least the pause of the checks, so that an error repeated every check is coalesced,
+            # the first notification of a target is not delayed
+            window = float(os.getenv("NOTIFY_WINDOW", 60))
+            # the sensor id changes on every container start, the command line does not
+            command = hashlib.sha256(json.dumps(sys.argv).encode()).hexdigest()
+            backlog_key = f"notifications:{command}"
+            _dispatcher = NotificationDispatcher(window=window, redis_client=create_redis_client(), backlog_key=backlog_key)
+        return _dispatcher
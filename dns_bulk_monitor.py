@@ -0,0 +1,251 @@
+import sys
+import time
+import json
+import asyncio
+import argparse
+import traceback
+import dns.asyncresolver
+from dns_monitor import DNSRecordMonitor
+from dispatcher import get_dispatcher
+from scheduler import create_schedule
+from utils import create_logger, create_redis_client, get_region, get_sensor_id, TokenBucket
+
+
+class DNSBulkMonitor(object):
+    """ Sweep a list of domains through a bounded async query pipeline.
+
+    Each line of the domain file is `<domain>[;resolvers=<resolvers>][;record_types=<record_types>]`,
+    blank lines and lines starting with `#` are ignored, malformed lines are logged and
+    skipped. Every domain is backed by a DNSRecordMonitor, so the Redis keys and alerts
+    are the same as with `--dns` targets, except for the domains seen for the first
+    time, summed up in a single message per sweep.
+    """
+    OPTIONS = ('resolvers', 'record_types')
+
+    def __init__(self, domain_file, resolvers=None, record_types=None, qps=50, concurrency=200,
+                 batch_size=100, timeout=10, slack_webhook_url=None):
+        self.domain_file = domain_file
+        self.resolvers = resolvers
+        self.record_types = record_types
+        self.qps = float(qps)
+        self.concurrency = int(concurrency)
+        self.batch_size = int(batch_size)
+        self.timeout = float(timeout)
+        self.slack_webhook_url = slack_webhook_url
+        self.redis_client = create_redis_client()
+        self.prefix = f"[sensorid={get_sensor_id()}][mod={self.__class__.__name__}][geo={get_region()}][domain_file={domain_file}]"
+        self.logger = create_logger(self.prefix)
+        self.monitors = {}
+        self.buckets = {}
+        self.async_resolvers = {}
+
+    def read_domains(self):
+        """ Yield (domain, resolvers, record_types) for each valid line of the domain file """
+        with open(self.domain_file, 'r') as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    yield self.parse_line(line)
+                except ValueError as e:
+                    self.logger.warning(f"skipping line {number} of {self.domain_file}: {e}")
+
+    def parse_line(self, line):
+        domain, *options = line.split(';')
+        spec = {'resolvers': self.resolvers, 'record_types': self.record_types}
+        if not domain.strip() or '=' in domain:
+            raise ValueError(f"no domain in {line!r}")
+        for option in options:
+            if '=' not in option:
+                raise ValueError(f"malformed option {option!r}")
+            key, value = option.split('=', 1)
+            if key.strip() not in self.OPTIONS:
+                raise ValueError(f"unknown option {key.strip()!r}")
+            spec[key.strip()] = value.strip()
+        return domain.strip(), spec['resolvers'], spec['record_types']
+
+    def get_monitor(self, domain, resolvers, record_types):
+        key = (domain, resolvers, record_types)
+        monitor = self.monitors.get(key)
+        if monitor is None:
+            monitor = DNSRecordMonitor(domain, resolvers, record_types, slack_webhook_url=self.slack_webhook_url,
+                                       timeout=self.timeout)
+            self.monitors[key] = monitor
+        return monitor
+
+    def get_bucket(self, nameserver):
+        bucket = self.buckets.get(nameserver)
+        if bucket is None:
+            bucket = TokenBucket(self.qps)
+            self.buckets[nameserver] = bucket
+        return bucket
+
+    def get_async_resolver(self, nameserver, port):
+        resolver = self.async_resolvers.get((nameserver, port))
+        if resolver is None:
+            resolver = dns.asyncresolver.Resolver(configure=False)
+            resolver.nameservers = [nameserver]
+            resolver.port = port
+            resolver.lifetime = self.timeout
+            self.async_resolvers[(nameserver, port)] = resolver
+        return resolver
+
+    def resolve(self, monitor, record_type):
+        """ Resolve one record type with the monitor, within the rate limit of each resolver """
+        async def get_resolver(nameserver):
+            await self.get_bucket(nameserver).async_acquire()
+            return self.get_async_resolver(nameserver, monitor.resolver.port)
+        return monitor.async_resolve(record_type, get_resolver)
+
+    async def fetch_new_records(self, monitor):
+        monitor.reset_ttls()
+        answers = await asyncio.gather(*[self.resolve(monitor, t) for t in monitor.record_types])
+        records = {t: a for t, a in zip(monitor.record_types, answers) if a}
+        failed = {t for t, a in zip(monitor.record_types, answers) if a is None}
+        if failed:
+            # the last known records may have to be read from Redis
+            loop = asyncio.get_running_loop()
+            records = await loop.run_in_executor(None, monitor.keep_failed, records, failed)
+        monitor.known_records = dict(records)
+        return records
+
+    def flush(self, batch):
+        """ Compare a batch of results with the cached records using pipelined Redis calls.
+
+        Only the digests are read for the whole batch, the cached records of the
+        domains whose digest changed are read and compared in a second round trip.
+        Domains seen for the first time are not reported, return their number.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        indexes = [monitor.queue_get_cached_digest(pipe) for monitor, records in batch]
+        results = pipe.execute()
+        digests = [results[i] for i in indexes]
+        pending = []
+        for (monitor, records), cached_digest in zip(batch, digests):
+            digest = monitor.records_digest(records)
+            if cached_digest is None or cached_digest.decode() != digest:
+                pending.append((monitor, records, digest))
+        if not pending:
+            return 0
+        pipe = self.redis_client.pipeline(transaction=False)
+        indexes = [monitor.queue_get_cached_records(pipe) for monitor, records, digest in pending]
+        results = pipe.execute()
+        cached = [results[i] for i in indexes]
+        pipe = self.redis_client.pipeline(transaction=False)
+        reports = []
+        for (monitor, records, digest), cached_records in zip(pending, cached):
+            cached_records = json.loads(cached_records) if cached_records else None
+            changed, msg, changes = monitor.compare_records(cached_records, records)
+            monitor.store_records_in_redis(records, pipe=pipe, digest=digest)
+            if cached_records is None or changed:
+                monitor.history.append(changes, records, pipe=pipe)
+            reports.append((monitor, changed, msg, changes, cached_records))
+        pipe.execute()
+        new = 0
+        for monitor, changed, msg, changes, cached_records in reports:
+            if cached_records is None:
+                new += 1
+                continue
+            monitor.report(changed, msg, changes)
+        return new
+
+    async def sweep(self):
+        """ Check every domain of the domain file once """
+        loop = asyncio.get_running_loop()
+        domains = asyncio.Queue(maxsize=self.concurrency)
+        results = asyncio.Queue(maxsize=self.batch_size * 2)
+        count = 0
+        new = 0
+
+        async def worker():
+            while True:
+                monitor = await domains.get()
+                try:
+                    records = await self.fetch_new_records(monitor)
+                    await results.put((monitor, records))
+                except Exception as e:
+                    monitor.logger.error(f"could not check {monitor.domain}: {e}", exc_info=True)
+                finally:
+                    domains.task_done()
+
+        async def writer():
+            nonlocal new
+            batch = []
+            while True:
+                item = await results.get()
+                if item is not None:
+                    batch.append(item)
+                if batch and (item is None or len(batch) >= self.batch_size or results.empty()):
+                    try:
+                        new += await loop.run_in_executor(None, self.flush, batch)
+                    except Exception as e:
+                        self.logger.error(f"could not store {len(batch)} results: {e}", exc_info=True)
+                    batch = []
+                if item is None:
+                    return
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        writer_task = asyncio.create_task(writer())
+        for domain, resolvers, record_types in self.read_domains():
+            try:
+                monitor = self.get_monitor(domain, resolvers, record_types)
+            except Exception as e:
+                self.logger.warning(f"skipping {domain}: {e}")
+                continue
+            await domains.put(monitor)
+            count += 1
+        await domains.join()
+        for w in workers:
+            w.cancel()
+        await results.put(None)
+        await writer_task
+        if new:
+            # a single message instead of one per domain, e.g. on the first sweep
+            self.notify(f":information_source: *{self.prefix}*\n{new} new domain(s), records cached")
+        return count
+
+    def notify(self, message):
+        get_dispatcher().notify(self.slack_webhook_url, self.prefix, message)
+
+    def serve_forever(self, pause=300):
+        self.notify(f":alert: *{self.prefix}*\nprocess started")
+        schedule = create_schedule(pause, self.domain_file)
+        while True:
+            try:
+                skipped = schedule.advance()
+                if skipped:
+                    self.logger.warning(f"sweep overran its {pause} seconds interval, skipped {skipped} cycle(s)")
+                schedule.sleep()
+                started = time.monotonic()
+                count = asyncio.run(self.sweep())
+                self.logger.info(f"swept {count} domains in {time.monotonic() - started:.1f} seconds")
+            except KeyboardInterrupt:
+                self.notify(f":alert: *{self.prefix}*\nprocess interrupted, exiting...")
+                break
+            except Exception as e:
+                self.logger.error(f"{e}", exc_info=True)
+                slack_message = f":ouch: *{self.prefix}*\nerror: {e}"
+                slack_message += f"\n```{traceback.format_exc()}```"
+                self.notify(slack_message)
+        self.notify(f":alert: *{self.prefix}*\nprocess stopped")
+        get_dispatcher().close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=DNSBulkMonitor.__name__)
+    parser.add_argument('--domain_file', type=str, help='File with one domain per line', required=True)
+    parser.add_argument('--resolvers', type=str, help="Default DNS resolvers addresses (comma separated list). Default 208.67.222.222,208.67.220.220.", default=None)
+    parser.add_argument("--record_types", help="Default DNS record types to monitor (comma separated list). Default A,AAAA,MX,NS,TXT,CNAME,SOA.", default=None)
+    parser.add_argument("--qps", type=float, help="Maximum queries per second sent to each resolver (default 50)", default=50)
+    parser.add_argument("--concurrency", type=int, help="Maximum domains resolved at the same time (default 200)", default=200)
+    parser.add_argument("--batch_size", type=int, help="Maximum results stored per Redis pipeline (default 100)", default=100)
+    parser.add_argument("--timeout", type=float, help="Timeout in seconds of each DNS query (default 10)", default=10)
+    parser.add_argument("--slack_webhook_url", help="slack webhook url (default disabled)", default=None)
+    parser.add_argument("--pause", help="pause time in seconds (default 300) between each sweep", type=int, default=300)
+    args = parser.parse_args()
+    monitor = DNSBulkMonitor(args.domain_file, resolvers=args.resolvers, record_types=args.record_types, qps=args.qps,
+                             concurrency=args.concurrency, batch_size=args.batch_size, timeout=args.timeout,
+                             slack_webhook_url=args.slack_webhook_url)
+    monitor.serve_forever(pause=args.pause)
+    sys.exit(0)
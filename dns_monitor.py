@@ -1,8 +1,80 @@
+import os
+import time
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from base_monitor import BaseMonitor, MonitorFactory
+from utils import str2bool
+from propagation import create_propagation_recorder
+import dns.flags
+import dns.query
+import dns.rcode
+import dns.message
 import dns.resolver
+import dns.rdatatype
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+def get_resolve_executor():
+    """ Return the thread pool shared by all DNS monitors to resolve record types concurrently """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None:
+            _executor_workers = int(os.getenv("DNS_WORKERS", 64))
+            _executor = ThreadPoolExecutor(max_workers=_executor_workers, thread_name_prefix="dns")
+        return _executor
+
+def size_resolve_executor(workers):
+    """ Grow the shared pool to at least `workers` threads, so that concurrent checks
+    never wait for each other's queries. DNS_WORKERS, when set, is kept as is """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if os.getenv("DNS_WORKERS") or workers <= _executor_workers:
+            return
+        previous = _executor
+        _executor_workers = workers
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dns")
+    if previous is not None:
+        previous.shutdown(wait=False)
 
 class DNSRecordMonitor(BaseMonitor):
-    def __init__(self, domain, resolvers=None, record_types=None, slack_webhook_url=None):
+    """ Monitor the DNS records of a domain.
+
+    With `soa_gate`, each check first asks for the SOA of the zone of the domain
+    (the domain itself only at the apex of the zone) and only
+    resolves every record type when its serial changed since the last full
+    sweep, or when the last full sweep is older than `full_sweep_interval`
+    seconds. Meant for zones whose serial is bumped on every change.
+
+    With `adaptive`, the next check is scheduled when the shortest TTL of the
+    last answers expires, clamped between `min_pause` and `max_pause` (default
+    MAX_PAUSE_FACTOR times the pause), and every `min_pause` seconds for `burst_duration` seconds after
+    a change was detected.
+
+    With `authoritative`, the resolvers are only used to find the
+    authoritative servers of the zone (cached for the TTL of its NS set),
+    then every server is queried directly. The records are the union of
+    their answers and disagreements between servers are reported.
+
+    With `fan_out`, every resolver is asked every record type concurrently
+    instead of using the first one that answers. As with `authoritative`, the
+    records are the union of their answers, disagreements are reported and
+    the answers of each source are kept in the `<redis key>:sources` hash.
+
+    With PROPAGATION_REDIS_URL set, the time each source first answers a new
+    rdata set is recorded in that Redis to measure propagation delays, see
+    propagation.py.
+    """
+    # with adaptive, long TTLs back off up to this many pauses unless max_pause is set
+    MAX_PAUSE_FACTOR = 10
+    # authoritative servers assumed per zone to size the resolve pool
+    AUTHORITATIVE_SERVERS_HINT = 4
+
+    def __init__(self, domain, resolvers=None, record_types=None, slack_webhook_url=None, timeout=10, port=53,
+                 soa_gate=False, full_sweep_interval=3600, adaptive=False, min_pause=10, max_pause=None,
+                 burst_duration=300, authoritative=False, fan_out=False):
         self.domain = domain.lower().strip()
         if not self.domain:
             raise ValueError("domain is required")
@@ -10,25 +82,346 @@ class DNSRecordMonitor(BaseMonitor):
             resolvers = '208.67.222.222,208.67.220.220'
         if not record_types or record_types == 'auto':
             record_types = 'A,AAAA,MX,NS,TXT,CNAME,SOA'
-        BaseMonitor.__init__(self, slack_webhook_url=slack_webhook_url, domain=domain, resolvers=resolvers)
+        # authoritative answers are kept apart from the answers of the resolvers
+        mode = {'authoritative': True} if authoritative else {'fan_out': True} if fan_out else {}
+        BaseMonitor.__init__(self, slack_webhook_url=slack_webhook_url, domain=domain, resolvers=resolvers, **mode)
         self.resolver = dns.resolver.Resolver()
         self.resolver.nameservers = list(set([ x.strip() for x in resolvers.split(',') ]))
+        self.resolver.port = int(port)
+        self.timeout = float(timeout)
+        # no single query may outlive the deadline of the whole check
+        self.resolver.lifetime = self.timeout
         self.record_types = list(set([ x.strip() for x in record_types.split(',') ]))
+        self.soa_gate = soa_gate
+        self.full_sweep_interval = float(full_sweep_interval)
+        self.last_records = None
+        self.last_serial = None
+        # zone of the domain, found on the first SOA gate
+        self.zone = None
+        self.last_full_sweep = None
+        self.adaptive = adaptive
+        self.min_pause = float(min_pause)
+        self.max_pause = float(max_pause) if max_pause else None
+        self.burst_duration = float(burst_duration)
+        self.burst_until = 0
+        # TTL of the answers of the last check, kept out of the records so they don't look like changes
+        self.record_ttls = {}
+        self.ttl_lock = threading.Lock()
+        # bumped on each check, answers of a previous check arriving late are ignored
+        self.ttl_generation = 0
+        self.authoritative = authoritative
+        self.authoritative_servers = None
+        self.authoritative_expiry = 0
+        self.last_divergence = None
+        self.fan_out = fan_out
+        self.resolvers = {}
+        for address in self.resolver.nameservers:
+            resolver = dns.resolver.Resolver(configure=False)
+            resolver.nameservers = [address]
+            resolver.port = self.resolver.port
+            resolver.lifetime = self.timeout
+            self.resolvers[address] = resolver
+        # records of the last sweep, kept for the record types that fail to resolve
+        self.known_records = None
+        self.failed_types = set()
+        self.sources_key = f"{self.redis_key}:sources"
+        self.source_records = {}
+        self.stored_source_records = None
+        # first observation of each rdata set, with PROPAGATION_REDIS_URL
+        self.propagation = create_propagation_recorder(self)
+        # set by a NotifyListener, checks are then triggered by NOTIFY messages
+        self.safety_pause = None
 
-    def fetch_new_records(self):
-        records = {}
-        self.logger.debug(f"fetching DNS records for {self.domain} using resolvers {self.resolver.nameservers}")
-        for record_type in self.record_types:
+    def reset_ttls(self):
+        with self.ttl_lock:
+            self.ttl_generation += 1
+            self.record_ttls = {}
+
+    def _keep_ttl(self, record_type, ttl, generation=None):
+        with self.ttl_lock:
+            if generation is not None and generation != self.ttl_generation:
+                return
+            previous = self.record_ttls.get(record_type)
+            self.record_ttls[record_type] = ttl if previous is None else min(previous, ttl)
+
+    def _answers(self, record_type, answers, generation=None):
+        self._keep_ttl(record_type, answers.rrset.ttl, generation)
+        return [str(rdata) for rdata in answers]
+
+    def _resolve_failed(self, record_type, error, source=None):
+        """ Return [] if error means there is no such record, None on failure """
+        if isinstance(error, (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN)):
+            self.logger.warning(f"skipping {record_type}: {error}")
+            return []
+        self.logger.warning(f"skipping {record_type}{' from ' + source if source else ''}: could not fetch record: {error}")
+        return None
+
+    def _resolve(self, record_type, resolver=None, generation=None, name=None):
+        """ Return [] if there is no such record, None on failure """
+        resolver = resolver or self.resolver
+        try:
+            self.logger.debug(f"fetching {record_type} records")
+            answers = resolver.resolve(name or self.domain, record_type)
+        except Exception as e:
+            return self._resolve_failed(record_type, e)
+        return self._answers(record_type, answers, generation)
+
+    async def async_resolve(self, record_type, get_resolver):
+        """ Same as _resolve with dns.asyncresolver, failing over between the resolvers.
+        get_resolver is a coroutine function returning the async resolver of a nameserver """
+        for nameserver in self.resolver.nameservers:
+            resolver = await get_resolver(nameserver)
+            try:
+                answers = await resolver.resolve(self.domain, record_type)
+            except Exception as e:
+                result = self._resolve_failed(record_type, e, nameserver)
+                if result is None:
+                    continue
+                return result
+            return self._answers(record_type, answers)
+        return None
+
+    def get_authoritative_servers(self, deadline):
+        """ Return {name: [addresses]} of the authoritative servers of the domain, cached for the TTL of
+        the NS set. The addresses of the servers are resolved concurrently, all before deadline """
+        if self.authoritative_servers and time.monotonic() < self.authoritative_expiry:
+            return self.authoritative_servers
+        zone = dns.resolver.zone_for_name(self.domain, resolver=self.resolver, lifetime=self.remaining(deadline))
+        answers = self.resolver.resolve(zone, 'NS', lifetime=self.remaining(deadline))
+        executor = get_resolve_executor()
+        futures = {executor.submit(self.resolver.resolve, str(rdata.target), 'A', lifetime=self.remaining(deadline)): str(rdata.target)
+                   for rdata in answers}
+        done, not_done = wait(futures, timeout=self.remaining(deadline))
+        servers = {}
+        for future in not_done:
+            future.cancel()
+            self.logger.warning(f"skipping authoritative server {futures[future]}: no address within the deadline")
+        for future in done:
+            name = futures[future]
             try:
-                self.logger.debug(f"fetching {record_type} records")
-                answers = self.resolver.resolve(self.domain, record_type)
-                records[record_type] = [str(rdata) for rdata in answers]
-            except dns.resolver.NoAnswer as ne:
-                self.logger.warning(f"skipping {record_type}: {ne}")
+                servers[name] = sorted(str(rdata) for rdata in future.result())
             except Exception as e:
-                self.logger.warning(f"skipping {record_type}: could not fetch record: {e}", exc_info=True)
+                self.logger.warning(f"skipping authoritative server {name}: could not resolve its address: {e}")
+        if not servers:
+            raise ValueError(f"no authoritative server found for {zone}")
+        self.logger.debug(f"authoritative servers of {zone}: {servers}")
+        self.authoritative_servers = servers
+        # looked up again on the next check when a server is missing
+        complete = len(servers) == len(futures)
+        self.authoritative_expiry = time.monotonic() + (answers.rrset.ttl if complete else 0)
+        return servers
+
+    @staticmethod
+    def remaining(deadline):
+        return max(deadline - time.monotonic(), 0.001)
+
+    def _query_server(self, address, record_type, generation=None, name=None, deadline=None):
+        """ Ask address directly, over TCP if the UDP answer is truncated, both before deadline.
+        Return [] if there is no such record, None on failure """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        try:
+            rdtype = dns.rdatatype.from_text(record_type)
+            query = dns.message.make_query(name or self.domain, rdtype)
+            response = dns.query.udp(query, address, timeout=self.remaining(deadline), port=self.resolver.port)
+            if response.flags & dns.flags.TC:
+                response = dns.query.tcp(query, address, timeout=self.remaining(deadline), port=self.resolver.port)
+            if response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+                raise ValueError(dns.rcode.to_text(response.rcode()))
+            for rrset in response.answer:
+                if rrset.rdtype == rdtype:
+                    self._keep_ttl(record_type, rrset.ttl, generation)
+                    return [str(rdata) for rdata in rrset]
+            return []
+        except Exception as e:
+            self.logger.warning(f"skipping {record_type} from {address}: could not fetch record: {e}")
+        return None
+
+    @staticmethod
+    def soa_serial(answers):
+        """ Highest serial of a SOA answer, None if there is none """
+        serials = []
+        for answer in answers or []:
+            try:
+                serials.append(int(answer.split()[2]))
+            except (IndexError, ValueError):
+                pass
+        return max(serials) if serials else None
+
+    def zone_serial(self):
+        """ Highest SOA serial of the zone of the domain, asked to the same sources as the
+        records, None on failure. Names below the apex have no SOA record of their own """
+        executor = get_resolve_executor()
+        deadline = time.monotonic() + self.timeout
+        try:
+            if self.zone is None:
+                self.zone = dns.resolver.zone_for_name(self.domain, resolver=self.resolver, lifetime=self.remaining(deadline)).to_text()
+            if self.authoritative:
+                futures = [executor.submit(self._query_server, address, 'SOA', None, self.zone, deadline)
+                           for addresses in self.get_authoritative_servers(deadline).values() for address in addresses]
+            else:
+                resolvers = self.resolvers.values() if self.fan_out else [None]
+                futures = [executor.submit(self._resolve, 'SOA', resolver, None, self.zone) for resolver in resolvers]
+        except Exception as e:
+            self.logger.warning(f"could not find the zone of {self.domain}: {e}")
+            return None
+        done, not_done = wait(futures, timeout=self.remaining(deadline))
+        for future in not_done:
+            future.cancel()
+        return self.soa_serial([answer for future in done for answer in future.result() or []])
+
+    def report_divergence(self, record_types, answers):
+        """ Notify when the answers of the sources ({record_type: {source: answers}}) start or stop disagreeing """
+        previous = self.last_divergence or {}
+        divergence = {k: v for k, v in previous.items() if k not in record_types}
+        for record_type in record_types:
+            by_source = answers.get(record_type, {})
+            if len(set(tuple(sorted(a)) for a in by_source.values())) > 1:
+                divergence[record_type] = {source: sorted(a) for source, a in sorted(by_source.items())}
+        if divergence == previous:
+            return divergence
+        if divergence:
+            lines = [f"{record_type} {source}: {', '.join(a) or '(none)'}"
+                     for record_type, by_source in sorted(divergence.items()) for source, a in by_source.items()]
+            self.logger.warning(f"answers disagree: {divergence}")
+            self.notify(f":warning: *{self.prefix}*\nanswers disagree:\n```" + "\n".join(lines) + "```")
+        else:
+            self.logger.info("answers agree again")
+            self.notify(f":white_check_mark: *{self.prefix}*\nanswers agree again")
+        self.last_divergence = divergence
+        return divergence
+
+    @property
+    def resolve_width(self):
+        """ Queries of a sweep running at the same time """
+        record_types = len(self.record_types) + (1 if self.soa_gate else 0)
+        if self.authoritative:
+            return record_types * self.AUTHORITATIVE_SERVERS_HINT
+        if self.fan_out:
+            return record_types * len(self.resolvers)
+        return record_types
+
+    def resolve(self, record_types):
+        """ Resolve record_types concurrently, within a deadline of self.timeout seconds.
+        The record types no source answered are left in self.failed_types """
+        executor = get_resolve_executor()
+        generation = self.ttl_generation
+        deadline = time.monotonic() + self.timeout
+        if self.authoritative:
+            servers = self.get_authoritative_servers(deadline)
+            futures = {executor.submit(self._query_server, address, record_type, generation, None, deadline): (record_type, f"{name} ({address})")
+                       for record_type in record_types for name, addresses in servers.items() for address in addresses}
+        elif self.fan_out:
+            futures = {executor.submit(self._resolve, record_type, resolver, generation): (record_type, address)
+                       for record_type in record_types for address, resolver in self.resolvers.items()}
+        else:
+            futures = {executor.submit(self._resolve, record_type, None, generation): (record_type, None)
+                       for record_type in record_types}
+        done, not_done = wait(futures, timeout=self.remaining(deadline))
+        for future in not_done:
+            future.cancel()
+            record_type, source = futures[future]
+            self.logger.warning(f"skipping {record_type}{' from ' + source if source else ''}: no answer within {self.timeout} seconds")
+        records = {}
+        by_source = {}
+        observed = {}
+        self.failed_types = set(record_types)
+        for future in done:
+            record_type, source = futures[future]
+            answers = future.result()
+            if answers is None:
+                continue
+            self.failed_types.discard(record_type)
+            observed[(record_type, source or ",".join(self.resolver.nameservers))] = answers
+            if source:
+                by_source.setdefault(record_type, {})[source] = answers
+                # sorted, round-robin resolvers reorder their answers on every query
+                self.source_records.setdefault(source, {})[record_type] = sorted(answers)
+            if answers:
+                # union of the answers of all sources
+                records[record_type] = list(dict.fromkeys(records.get(record_type, []) + answers))
+        if self.authoritative or self.fan_out:
+            self.report_divergence(record_types, by_source)
+        if self.propagation:
+            self.propagation.observe(observed)
         return records
 
+    def store_source_records(self):
+        """ Keep the answers of each source in a hash, written when they changed """
+        if not self.source_records or self.source_records == self.stored_source_records:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.delete(self.sources_key)
+        pipe.hset(self.sources_key, mapping={source: json.dumps(records, sort_keys=True)
+                                             for source, records in self.source_records.items()})
+        pipe.expire(self.sources_key, self.REDIS_TTL)
+        pipe.execute()
+        self.stored_source_records = json.loads(json.dumps(self.source_records))
+
+    def fetch_new_records(self):
+        self.reset_ttls()
+        if self.soa_gate and self.last_records is not None \
+                and time.monotonic() - self.last_full_sweep < self.full_sweep_interval:
+            serial = self.zone_serial()
+            if serial is not None and serial == self.last_serial:
+                self.logger.debug(f"SOA serial {serial} of {self.zone} not changed, skipping the full sweep")
+                return dict(self.last_records)
+            self.logger.info(f"SOA serial changed from {self.last_serial} to {serial}, running a full sweep")
+            return self.sweep(serial)
+        return self.sweep()
+
+    def sweep(self, serial=None):
+        """ Resolve all record types, serial is the SOA serial of the zone if it was just read """
+        self.logger.debug(f"fetching DNS records for {self.domain} using resolvers {self.resolver.nameservers}")
+        if self.soa_gate and serial is None:
+            # read first, a change made during the sweep is caught by the next check
+            serial = self.zone_serial()
+        self.source_records = {}
+        records = self.keep_failed(self.resolve(self.record_types), self.failed_types)
+        self.known_records = dict(records)
+        if self.soa_gate:
+            self.last_serial = serial
+            self.last_records = dict(records)
+            self.last_full_sweep = time.monotonic()
+        return records
+
+    def keep_failed(self, records, failed_types):
+        """ Keep the last known records of the record types that failed to resolve, so that a slow
+        or dead resolver isn't reported as the records being removed, then added back """
+        if not failed_types:
+            return records
+        known = self.known_records
+        if known is None:
+            cached = BaseMonitor.get_cached_records(self)
+            known = json.loads(cached) if cached else {}
+        for record_type in failed_types:
+            if record_type in known:
+                records[record_type] = known[record_type]
+        self.logger.warning(f"keeping the last known records of {', '.join(sorted(failed_types))}")
+        return records
+
+    def detect_changes(self, records=None):
+        changed, msg, changes = BaseMonitor.detect_changes(self, records)
+        self.store_source_records()
+        if changed and self.adaptive:
+            self.burst_until = time.monotonic() + self.burst_duration
+        return changed, msg, changes
+
+    def next_interval(self, pause):
+        if self.adaptive and time.monotonic() < self.burst_until:
+            return self.min_pause
+        if self.safety_pause:
+            return self.safety_pause
+        if not self.adaptive:
+            return pause
+        max_pause = self.max_pause or pause * self.MAX_PAUSE_FACTOR
+        with self.ttl_lock:
+            ttls = list(self.record_ttls.values())
+        if not ttls:
+            return pause
+        # a recursive resolver returns the remaining TTL, its cached answer can't change before
+        return min(max(min(ttls) + 1, self.min_pause), max_pause)
+
 class DNSMonitorFactory(MonitorFactory):
     def __init__(self, monitor_class=DNSRecordMonitor):
         MonitorFactory.__init__(self, monitor_class)
@@ -37,12 +430,38 @@ class DNSMonitorFactory(MonitorFactory):
         self.parser.add_argument('--domain', type=str, help='Domain to monitor', default=None, required=True)
         self.parser.add_argument('--resolvers', type=str, help="DNS resolvers addresses (comma separated list). Default 208.67.222.222,208.67.220.220.", default=None)
         self.parser.add_argument("--record_types", help="DNS record types to monitor (comma separated list). Default A,AAAA,MX,NS,TXT,CNAME,SOA.", default=None)
+        self.parser.add_argument("--timeout", type=float, help="deadline in seconds for a whole check (default 10)", default=10)
+        self.parser.add_argument("--soa_gate", type=str2bool, help="only resolve every record type when the SOA serial changed (default False)", default=False)
+        self.parser.add_argument("--full_sweep_interval", type=float, help="with --soa_gate, resolve every record type at least every N seconds (default 3600)", default=3600)
+        self.parser.add_argument("--adaptive", type=str2bool, help="schedule the next check from the TTL of the answers (default False)", default=False)
+        self.parser.add_argument("--min_pause", type=float, help="with --adaptive, minimum seconds between checks, also used after a change (default 10)", default=10)
+        self.parser.add_argument("--max_pause", type=float, help="with --adaptive, maximum seconds between checks (default 10 times --pause)", default=None)
+        self.parser.add_argument("--burst_duration", type=float, help="with --adaptive, seconds of checks every --min_pause after a change (default 300)", default=300)
+        self.parser.add_argument("--authoritative", type=str2bool, help="query the authoritative servers of the zone directly (default False)", default=False)
+        self.parser.add_argument("--fan_out", type=str2bool, help="ask every resolver concurrently and report disagreements (default False)", default=False)
+        self.parser.add_argument("--notify_port", type=int, help="check when a DNS NOTIFY is received on this port, requires --authoritative (default disabled)", default=None)
+        self.parser.add_argument("--notify_primaries", type=str, help="addresses or networks allowed to send NOTIFY (comma separated list)", default=None)
+        self.parser.add_argument("--safety_pause", type=float, help="with --notify_port, seconds between checks without NOTIFY (default 3600)", default=3600)
         self.parser.add_argument("--slack_webhook_url", help="slack webhook url (default disabled)", default=None)
         self.parser.add_argument("--pause", help="pause time in seconds (default 60) between each check", type=int, default=60)
+        self.parser.add_argument("--metrics_port", type=int, help="serve Prometheus metrics on this port (default disabled)", default=None)
         self.args = self.parser.parse_args()
+        if self.args.notify_port and not self.args.authoritative:
+            self.parser.error("--notify_port requires --authoritative: recursive resolvers keep serving the old answers after a NOTIFY")
         self.slack_webhook_url = self.args.slack_webhook_url
         self.pause = self.args.pause
-        self.monitor = self.monitor_class(self.args.domain, self.args.resolvers, self.args.record_types, self.slack_webhook_url)
+        self.monitor = self.monitor_class(self.args.domain, self.args.resolvers, self.args.record_types, self.slack_webhook_url,
+                                          timeout=self.args.timeout, soa_gate=self.args.soa_gate,
+                                          full_sweep_interval=self.args.full_sweep_interval, adaptive=self.args.adaptive,
+                                          min_pause=self.args.min_pause, max_pause=self.args.max_pause,
+                                          burst_duration=self.args.burst_duration, authoritative=self.args.authoritative,
+                                          fan_out=self.args.fan_out)
+        if self.args.notify_port:
+            from dns_notify_listener import NotifyListener
+            listener = NotifyListener(self.args.notify_primaries, port=self.args.notify_port, safety_pause=self.args.safety_pause)
+            listener.add(self.monitor)
+            listener.start()
+        self.start_metrics_server()
         self.monitor.serve_forever(pause=self.pause)
         return self.monitor
 
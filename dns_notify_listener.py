@@ -0,0 +1,111 @@
+import sys
+import socket
+import argparse
+import ipaddress
+from dnslib import DNSRecord, DNSQuestion, QTYPE, OPCODE, RCODE
+from dnslib.server import DNSServer, BaseResolver, DNSLogger
+from utils import create_logger, get_region, get_sensor_id
+
+
+class NotifyResolver(BaseResolver):
+    """ Answer DNS NOTIFY messages (RFC 1996) and trigger the checks of the notified zone """
+    def __init__(self, listener):
+        self.listener = listener
+
+    def resolve(self, request, handler):
+        reply = request.reply()
+        if request.header.opcode != OPCODE.NOTIFY:
+            reply.header.rcode = RCODE.NOTIMP
+            return reply
+        if not self.listener.is_allowed(handler.client_address[0]):
+            self.listener.logger.warning(f"refusing NOTIFY for {request.q.qname} from {handler.client_address[0]}")
+            reply.header.rcode = RCODE.REFUSED
+            return reply
+        self.listener.notified(str(request.q.qname), handler.client_address[0])
+        return reply
+
+
+class NotifyListener(object):
+    """ Listen for DNS NOTIFY messages from the primaries of the monitored zones.
+
+    A NOTIFY for a zone triggers the check of every DNS monitor of the zone and of
+    its subdomains right away. While the listener is running, these monitors only
+    poll every `safety_pause` seconds in case a NOTIFY gets lost.
+
+    Only monitors in authoritative mode are attached: right after a NOTIFY,
+    recursive resolvers still serve the old answers until their TTL expires, so
+    the triggered check would see nothing and the next one would be an hour away.
+    """
+    def __init__(self, primaries, host='0.0.0.0', port=53, safety_pause=3600):
+        if isinstance(primaries, str):
+            primaries = primaries.split(',')
+        self.primaries = [ipaddress.ip_network(p.strip()) for p in primaries or [] if p.strip()]
+        if not self.primaries:
+            raise ValueError("at least one primary is required")
+        self.host = host
+        self.port = int(port)
+        self.safety_pause = safety_pause
+        self.monitors = []
+        self.servers = []
+        self.prefix = f"[sensorid={get_sensor_id()}][mod={self.__class__.__name__}][geo={get_region()}][port={self.port}]"
+        self.logger = create_logger(self.prefix)
+
+    def add(self, monitor):
+        """ Attach an authoritative monitor, return False (and keep its pause) for any other """
+        if not getattr(monitor, 'authoritative', False):
+            self.logger.warning(f"not attaching {monitor.domain}: NOTIFY requires authoritative mode, polling every pause instead")
+            return False
+        monitor.safety_pause = self.safety_pause
+        self.monitors.append(monitor)
+        return True
+
+    def is_allowed(self, address):
+        address = ipaddress.ip_address(address)
+        return any(address in network for network in self.primaries)
+
+    def notified(self, zone, address):
+        zone = zone.lower().rstrip('.')
+        monitors = [m for m in self.monitors if m.domain.rstrip('.') == zone or m.domain.rstrip('.').endswith('.' + zone)]
+        self.logger.info(f"NOTIFY for {zone} from {address}, triggering {len(monitors)} check(s)")
+        for monitor in monitors:
+            monitor.trigger()
+
+    def start(self):
+        """ Answer over UDP and TCP from background threads """
+        resolver = NotifyResolver(self)
+        dns_logger = DNSLogger(prefix=False, logf=lambda s: s)
+        for tcp in (False, True):
+            server = DNSServer(resolver, port=self.port, address=self.host, logger=dns_logger, tcp=tcp)
+            server.server.daemon_threads = True
+            server.start_thread()
+            self.servers.append(server)
+        self.logger.info(f"listening for NOTIFY on {self.host} port {self.port} from {', '.join(str(p) for p in self.primaries)}")
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+        self.servers = []
+
+
+def send_notify(zone, host, port=53, timeout=5):
+    """ Send a NOTIFY for zone to host and return the rcode of the answer, like a primary would """
+    request = DNSRecord(q=DNSQuestion(zone, QTYPE.SOA))
+    request.header.opcode = OPCODE.NOTIFY
+    request.header.aa = 1
+    request.header.rd = 0
+    answer = DNSRecord.parse(request.send(host, port, timeout=timeout))
+    return RCODE.get(answer.header.rcode)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send a DNS NOTIFY, e.g. to test a NotifyListener")
+    parser.add_argument('--zone', type=str, help='Zone to notify', required=True)
+    parser.add_argument('--host', type=str, help='Address of the listener (default 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='Port of the listener (default 53)', default=53)
+    args = parser.parse_args()
+    try:
+        print(send_notify(args.zone, args.host, args.port))
+    except socket.timeout:
+        print("no answer")
+        sys.exit(1)
+    sys.exit(0)
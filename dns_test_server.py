@@ -1,12 +1,14 @@
 import sys
-import random
+import time
 import socket
 import logging
-from dnslib import DNSRecord, RR, QTYPE, A, AAAA, MX, NS, TXT, CNAME, SOA
-from dnslib.server import DNSServer, BaseResolver, DNSLogger
+import argparse
+from dnslib import RR, QTYPE, RCODE, A, AAAA, MX, NS, TXT, CNAME, SOA, DNSError
+from dnslib.server import DNSServer, BaseResolver, DNSLogger, TCPServer
+import stand_in
 
 logger = logging.getLogger("DNSTestServer")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)
 ch = logging.StreamHandler()
 fh = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 ch.setFormatter(fh)
@@ -16,76 +18,89 @@ l = logging.getLogger("[DNSHandler:RandomDNSResolver]")
 l.setLevel(logging.ERROR)
 l.addHandler(ch)
 
-def is_true():
-    return bool(random.randint(0, 4))
+# allow a deep backlog of pending TCP connections
+TCPServer.request_queue_size = 4096
 
 
 class RandomDNSResolver(BaseResolver):
-    def __init__(self, ttl=60):
+    """ Answer each (name, type) with random records, changing at the behaviour change rate """
+    def __init__(self, ttl=60, behaviour=None):
         self.ttl = ttl
+        self.behaviour = behaviour or stand_in.StandInBehaviour()
+
+    def generate(self, qname, qtype, rng):
+        # one query out of five has no answer
+        if not rng.randint(0, 4):
+            return None
+        if qtype == 'A':
+            return QTYPE.A, A(socket.inet_ntoa(rng.randint(0, 0xFFFFFFFF).to_bytes(4, 'big')))
+        if qtype == 'AAAA':
+            ip = socket.inet_ntop(socket.AF_INET6, rng.randint(0, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF).to_bytes(16, 'big'))
+            return QTYPE.AAAA, AAAA(ip)
+        if qtype == 'MX':
+            return QTYPE.MX, MX(f'mail{rng.randint(1, 100)}.dummy.net')
+        if qtype == 'NS':
+            return QTYPE.NS, NS(f'ns{rng.randint(1, 100)}.dummy.net')
+        if qtype == 'TXT':
+            return QTYPE.TXT, TXT(f'text{rng.randint(1, 100)}')
+        if qtype == 'CNAME':
+            return QTYPE.CNAME, CNAME(f'alias{rng.randint(1, 100)}.dummy.net')
+        if qtype == 'SOA':
+            mname = f'ns{rng.randint(1, 100)}.dummy.net'
+            rname = f'admin{rng.randint(1, 100)}.dummy.net'
+            return QTYPE.SOA, SOA(mname, rname, (rng.randint(1, 2 ** 31), 3600, 600, 86400, self.ttl))
+        return None
 
     def resolve(self, request, handler):
         reply = request.reply()
         qname = request.q.qname
         qtype = QTYPE[request.q.qtype]
-
-        if qtype == 'A' and is_true():
-            ip = socket.inet_ntoa(random.randint(0, 0xFFFFFFFF).to_bytes(4, 'big'))
-            rr = RR(qname, QTYPE.A, rdata=A(ip), ttl=self.ttl)
-            reply.add_answer(rr)
-            logger.debug(f"Resolved {qname} {qtype} to {ip}")
-
-        elif qtype == 'AAAA' and is_true():
-            ip = socket.inet_ntop(socket.AF_INET6, random.randint(0, 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF).to_bytes(16, 'big'))
-            rr = RR(qname, QTYPE.AAAA, rdata=AAAA(ip), ttl=self.ttl)
-            reply.add_answer(rr)
-            logger.debug(f"Resolved {qname} {qtype} to {ip}")
-
-        elif qtype == 'MX' and is_true():
-            mailserver = f'mail{random.randint(1, 100)}.dummy.net'
-            rr = RR(qname, QTYPE.MX, rdata=MX(mailserver), ttl=self.ttl)
-            reply.add_answer(rr)
-            logger.debug(f"Resolved {qname} {qtype} to {mailserver}")
-
-        elif qtype == 'NS' and is_true():
-            nameserver = f'ns{random.randint(1, 100)}.dummy.net'
-            rr = RR(qname, QTYPE.NS, rdata=NS(nameserver), ttl=self.ttl)
-            reply.add_answer(rr)
-            logger.debug(f"Resolved {qname} {qtype} to {nameserver}")
-
-        elif qtype == 'TXT' and is_true():
-            txt_data = f'text{random.randint(1, 100)}'
-            rr = RR(qname, QTYPE.TXT, rdata=TXT(txt_data), ttl=self.ttl)
-            reply.add_answer(rr)
-            logger.debug(f"Resolved {qname} {qtype} to {txt_data}")
-
-        elif qtype == 'CNAME' and is_true():
-            cname = f'alias{random.randint(1, 100)}.dummy.net'
-            rr = RR(qname, QTYPE.CNAME, rdata=CNAME(cname), ttl=self.ttl)
-            reply.add_answer(rr)
-            logger.debug(f"Resolved {qname} {qtype} to {cname}")
-
-        elif qtype == 'SOA' and is_true():
-            mname = f'ns{random.randint(1, 100)}.dummy.net'
-            rname = f'admin{random.randint(1, 100)}.dummy.net'
-            rr = RR(qname, QTYPE.SOA, rdata=SOA(mname, rname), ttl=self.ttl)
-            reply.add_answer(rr)
-            logger.debug(f"Resolved {qname} {qtype} to {mname} {rname}")
-
+        fault, rng = self.behaviour.query((str(qname).lower(), qtype))
+        delay = self.behaviour.delay()
+        if delay:
+            time.sleep(delay)
+        if fault == 'timeout':
+            # dnslib drops the query without answering
+            raise DNSError("injected timeout")
+        if fault == 'error':
+            reply.header.rcode = RCODE.SERVFAIL
+            return reply
+        answer = self.generate(qname, qtype, rng)
+        if answer:
+            rtype, rdata = answer
+            reply.add_answer(RR(qname, rtype, rdata=rdata, ttl=self.ttl))
         return reply
 
-def run_server(host='127.0.0.1', port=53):
+
+def run_server(host='127.0.0.1', port=53, behaviour=None, tcp=False):
     logger.info(f"Starting up DNS server on {host} port {port}")
-    resolver = RandomDNSResolver()
-    server = DNSServer(resolver, port=port, address=host, 
-                       logger=DNSLogger(prefix=False,logf=lambda s:s))
-    server.start()
-    logger.info("Stopping DNS server")
+    resolver = RandomDNSResolver(behaviour=behaviour)
+    dns_logger = DNSLogger(prefix=False, logf=lambda s: s)
+    servers = [DNSServer(resolver, port=port, address=host, logger=dns_logger)]
+    if tcp:
+        servers.append(DNSServer(resolver, port=port, address=host, logger=dns_logger, tcp=True))
+    for server in servers:
+        # one thread per query
+        server.server.daemon_threads = True
+        server.start_thread()
+    try:
+        while all(server.isAlive() for server in servers):
+            time.sleep(1)
+    finally:
+        for server in servers:
+            server.stop()
+        logger.info("Stopping DNS server")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="DNS test server")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=53)
+    parser.add_argument('--tcp', action='store_true', help='Also answer over TCP')
+    stand_in.add_arguments(parser)
+    args = parser.parse_args()
+    logger.setLevel(args.log_level.upper())
     try:
-        run_server()
+        run_server(host=args.host, port=args.port, behaviour=stand_in.from_args(args), tcp=args.tcp)
     except KeyboardInterrupt:
         print("Shutting down DNS server")
     sys.exit(0)
-
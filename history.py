@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import json
+import argparse
+from datetime import datetime
+from record_diff import Change, apply_changes
+from utils import create_redis_client
+
+
+class ChangeHistory(object):
+    """ Append-only history of the changes of a monitor, stored in a Redis stream.
+
+    Each entry holds the changes of one cycle as a delta. Every `checkpoint_interval`
+    entries (and on the first entry written by a process) the full records are stored
+    too, so the state at any time can be rebuilt by replaying the deltas following
+    the nearest checkpoint.
+    """
+    def __init__(self, redis_client, key, maxlen=10000, max_age=None, checkpoint_interval=50):
+        self.redis_client = redis_client
+        self.key = key
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self.checkpoint_interval = checkpoint_interval
+        self.since_checkpoint = None
+
+    def append(self, changes, records, pipe=None):
+        """ Append the changes of a cycle, with records being the state after these changes """
+        fields = {'changes': json.dumps([c.to_dict() for c in changes])}
+        if self.since_checkpoint is None or self.since_checkpoint + 1 >= self.checkpoint_interval:
+            fields['snapshot'] = json.dumps(records)
+            self.since_checkpoint = 0
+        else:
+            self.since_checkpoint += 1
+        client = pipe if pipe is not None else self.redis_client.pipeline(transaction=False)
+        client.xadd(self.key, fields, maxlen=self.maxlen, approximate=True)
+        if self.max_age:
+            # trimming by age needs Redis >= 6.2
+            client.xtrim(self.key, minid=int((time.time() - self.max_age) * 1000), approximate=True)
+        if pipe is None:
+            client.execute()
+
+    @staticmethod
+    def _decode(entry):
+        entry_id, fields = entry
+        fields = {k.decode() if isinstance(k, bytes) else k: v for k, v in fields.items()}
+        changes = [Change.from_dict(c) for c in json.loads(fields['changes'])]
+        snapshot = json.loads(fields['snapshot']) if 'snapshot' in fields else None
+        entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+        return entry_id, changes, snapshot
+
+    @staticmethod
+    def _stream_id(timestamp):
+        return '+' if timestamp is None else str(int(timestamp * 1000))
+
+    def changes(self, start=None, end=None, count=None):
+        """ Return (timestamp, changes) for each entry between the start and end timestamps """
+        start_id = '-' if start is None else str(int(start * 1000))
+        entries = self.redis_client.xrange(self.key, min=start_id, max=self._stream_id(end), count=count)
+        history = []
+        for entry in entries:
+            entry_id, changes, snapshot = self._decode(entry)
+            history.append((int(entry_id.split('-')[0]) / 1000.0, changes))
+        return history
+
+    def state_at(self, timestamp=None):
+        """ Rebuild the records as they were at the given timestamp (default now), None if unknown """
+        end = self._stream_id(timestamp)
+        checkpoint_id = None
+        records = None
+        while checkpoint_id is None:
+            entries = self.redis_client.xrevrange(self.key, max=end, min='-', count=100)
+            # exclusive ranges need Redis >= 6.2, skip the page boundary instead
+            entries = [e for e in entries if e[0] != end and e[0] != end.encode()]
+            if not entries:
+                return None
+            for entry in entries:
+                entry_id, changes, snapshot = self._decode(entry)
+                if snapshot is not None:
+                    checkpoint_id, records = entry_id, snapshot
+                    break
+            else:
+                end = entry_id
+        for entry in self.redis_client.xrange(self.key, min=checkpoint_id, max=self._stream_id(timestamp)):
+            entry_id, changes, snapshot = self._decode(entry)
+            if entry_id != checkpoint_id:
+                records = apply_changes(records, changes)
+        return records
+
+
+def create_change_history(redis_client, key):
+    maxlen = int(os.getenv("HISTORY_MAXLEN", 10000))
+    max_age = os.getenv("HISTORY_MAX_AGE")
+    max_age = int(max_age) if max_age else None
+    checkpoint_interval = int(os.getenv("HISTORY_CHECKPOINT_INTERVAL", 50))
+    return ChangeHistory(redis_client, key, maxlen=maxlen, max_age=max_age, checkpoint_interval=checkpoint_interval)
+
+
+def parse_timestamp(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the change history of a monitor")
+    parser.add_argument('--redis_key', type=str, help='Redis key of the monitor', required=True)
+    parser.add_argument('--at', type=str, help='Rebuild the records at this time (epoch or ISO 8601, default now)', default=None)
+    parser.add_argument('--changes', action='store_true', help='List the changes instead of rebuilding the records')
+    parser.add_argument('--since', type=str, help='List the changes since this time (epoch or ISO 8601)', default=None)
+    args = parser.parse_args()
+    history = ChangeHistory(create_redis_client(), f"{args.redis_key}:history")
+    if args.changes:
+        for timestamp, changes in history.changes(start=parse_timestamp(args.since), end=parse_timestamp(args.at)):
+            print(json.dumps({'timestamp': timestamp, 'changes': [c.to_dict() for c in changes]}))
+    else:
+        print(json.dumps(history.state_at(parse_timestamp(args.at)), indent=2))
+    sys.exit(0)
@@ -1,12 +1,13 @@
-from utils import str2bool
+import json
+import hashlib
+from utils import str2bool, get_http_session
 from base_monitor import BaseMonitor, MonitorFactory
-import requests
 
 class HTTPMonitor(BaseMonitor):
     def __init__(self, url, method='GET', payload=None, headers=None, 
                  connect_timeout=5, timeout=15, 
                  verify_ssl=True,
-                 slack_webhook_url=None):
+                 slack_webhook_url=None, conditional=False, hash_body=False, max_bytes=None):
         self.url = url
         if not self.url:
             raise ValueError("url is required")
@@ -16,29 +17,87 @@ class HTTPMonitor(BaseMonitor):
         self.payload = payload
         self.headers = headers
         self.verify_ssl = verify_ssl
+        self.conditional = conditional
+        self.hash_body = hash_body
+        self.max_bytes = max_bytes
+        self.validators = {}
+        self.last_records = None
+        self.session = get_http_session(self.url)
         BaseMonitor.__init__(self, slack_webhook_url=slack_webhook_url, url=url, method=method)
 
+    def _request_headers(self):
+        headers = self.headers
+        if isinstance(headers, str):
+            headers = json.loads(headers) if headers.strip() else None
+        headers = dict(headers or {})
+        if self.conditional and self.last_records is not None:
+            if 'etag' in self.validators:
+                headers['If-None-Match'] = self.validators['etag']
+            if 'last_modified' in self.validators:
+                headers['If-Modified-Since'] = self.validators['last_modified']
+        return headers
+
+    PREVIEW_LENGTH = 200
+    CHUNK_SIZE = 65536
+
+    def _read_body(self, response):
+        """ Hash the body chunk by chunk, keeping only a preview and stopping after max_bytes """
+        digest = hashlib.sha256()
+        length = 0
+        preview = b''
+        truncated = False
+        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+            if self.max_bytes and length + len(chunk) > self.max_bytes:
+                chunk = chunk[:self.max_bytes - length]
+                truncated = True
+            digest.update(chunk)
+            length += len(chunk)
+            if len(preview) <= self.PREVIEW_LENGTH:
+                preview += chunk[:self.PREVIEW_LENGTH + 1 - len(preview)]
+            if truncated:
+                break
+        preview = preview.decode(response.encoding or 'utf-8', errors='replace')
+        if len(preview) > self.PREVIEW_LENGTH:
+            preview = preview[:self.PREVIEW_LENGTH] + '...'
+        return {'response_sha256': digest.hexdigest(),
+                'response_length': length,
+                'response_truncated': truncated,
+                'response_preview': preview}
+
     def fetch_new_records(self):
         records = {}
         self.logger.debug(f"fetching {self.method} {self.url}")
         try:
-            response = requests.request(self.method, self.url, 
-                                        data=self.payload, 
-                                        headers=self.headers, 
-                                        verify=self.verify_ssl,
-                                        timeout=(self.connect_timeout, self.timeout))
-            text = response.text[:200] + '...' if len(response.text) > 200 else response.text
-            records = {'url': self.url,
-                       'request_method': self.method, 
-                       'request_payload': self.payload,
-                       'request_headers': self.headers,
-                       'request_connect_timeout': self.connect_timeout,
-                       'request_timeout': self.timeout,
-                       'request_verify_ssl': self.verify_ssl,
-                       'response_text': text,
-                       'response_status_code': response.status_code
-                       }
+            with self.session.request(self.method, self.url, 
+                                      data=self.payload, 
+                                      headers=self._request_headers(), 
+                                      verify=self.verify_ssl,
+                                      timeout=(self.connect_timeout, self.timeout),
+                                      stream=self.hash_body) as response:
+                if self.conditional and response.status_code == 304 and self.last_records is not None:
+                    self.logger.debug(f"not modified since last check")
+                    return self.last_records
+                records = {'url': self.url,
+                           'request_method': self.method, 
+                           'request_payload': self.payload,
+                           'request_headers': self.headers,
+                           'request_connect_timeout': self.connect_timeout,
+                           'request_timeout': self.timeout,
+                           'request_verify_ssl': self.verify_ssl,
+                           'response_status_code': response.status_code
+                           }
+                if self.hash_body:
+                    records.update(self._read_body(response))
+                else:
+                    records['response_text'] = response.text[:200] + '...' if len(response.text) > 200 else response.text
             self.logger.debug(f"fetched url: {records}")
+            if self.conditional:
+                self.validators = {}
+                if response.headers.get('ETag'):
+                    self.validators['etag'] = response.headers['ETag']
+                if response.headers.get('Last-Modified'):
+                    self.validators['last_modified'] = response.headers['Last-Modified']
+                self.last_records = records
             return records
         except Exception as e:  
             self.logger.error(f"could not fetch url: {e}", exc_info=True)
@@ -57,14 +116,20 @@ class HTTPMonitorFactory(MonitorFactory):
         self.parser.add_argument("--connect_timeout", type=int, help="HTTP connect timeout (default 5 seconds)", default=5)
         self.parser.add_argument("--timeout", type=int, help="HTTP timeout (default 15 seconds)", default=15)
         self.parser.add_argument("--verify_ssl", type=str2bool, help="verify SSL (default True)", default=True)
+        self.parser.add_argument("--hash_body", type=str2bool, help="stream the body into a SHA-256 digest instead of keeping its first 200 characters (default False)", default=False)
+        self.parser.add_argument("--max_bytes", type=int, help="maximum body bytes hashed with --hash_body (default unlimited)", default=None)
+        self.parser.add_argument("--conditional", type=str2bool, help="revalidate with If-None-Match/If-Modified-Since (default False)", default=False)
         self.parser.add_argument("--slack_webhook_url", help="slack webhook url (default disabled)", default=None)
         self.parser.add_argument("--pause", help="pause time in seconds (default 60) between each check", type=int, default=60)
+        self.parser.add_argument("--metrics_port", type=int, help="serve Prometheus metrics on this port (default disabled)", default=None)
         self.args = self.parser.parse_args()
         self.slack_webhook_url = self.args.slack_webhook_url
         self.pause = self.args.pause
         self.monitor = self.monitor_class(self.args.url, method=self.args.method, payload=self.args.payload, headers=self.args.headers,
                                         connect_timeout=self.args.connect_timeout, timeout=self.args.timeout, verify_ssl=self.args.verify_ssl,
-                                        slack_webhook_url=self.slack_webhook_url)
+                                        slack_webhook_url=self.slack_webhook_url, conditional=self.args.conditional,
+                                        hash_body=self.args.hash_body, max_bytes=self.args.max_bytes)
+        self.start_metrics_server()
         self.monitor.serve_forever(pause=self.pause)
         return self.monitor
 
@@ -1,42 +1,100 @@
 import logging
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import ssl
-import random
 import sys
+import time
+import hashlib
+import argparse
+import stand_in
+
+# held open without answer for injected timeouts
+TIMEOUT_HOLD = 120
 
 logger = logging.getLogger("HTTPTestServer")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(logging.INFO)
 ch = logging.StreamHandler()
 fh = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 ch.setFormatter(fh)
 logger.addHandler(ch)
 
+
+class TestHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # allow a deep backlog of pending connections
+    request_queue_size = 4096
+
+
 class HelloWorldHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        logger.info("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
-        # Send response status code
-        code = random.choice([200, 201, 202, 401, 404, 500, 503])
-        self.send_response(code)
+    behaviour = stand_in.StandInBehaviour()
+    protocol_version = 'HTTP/1.1'
 
-        # Send headers
+    def respond(self):
+        logger.debug("%s request, Path: %s", self.command, self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        fault, rng = self.behaviour.query(self.path)
+        delay = self.behaviour.delay()
+        if delay:
+            time.sleep(delay)
+        if fault == 'timeout':
+            time.sleep(TIMEOUT_HOLD)
+            self.close_connection = True
+            return
+        if fault == 'error':
+            code = 500
+        else:
+            code = rng.choice([200, 201, 202, 401, 404, 500, 503])
+        body = f"Hello, World! {rng.randint(0, 2 ** 31)}".encode()
+        etag = '"' + hashlib.sha256(f"{code}:".encode() + body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(code)
         self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
         self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
 
-        # Send the html message
-        self.wfile.write(b"Hello, World!")
-        logger.info("Response sent.")
 
-def run_server(host='localhost', port=7777):
+def run_server(host='localhost', port=7777, keyfile="/app/key.pem", certfile="/app/certificate.pem", behaviour=None):
     # Server settings
     logger.info(f"Starting up HTTP server on {host} port {port}")
-    httpd = HTTPServer((host, port), HelloWorldHandler)
-    httpd.socket = ssl.wrap_socket(httpd.socket, keyfile="/app/key.pem", certfile="/app/certificate.pem", server_side=True)
+    if behaviour:
+        HelloWorldHandler.behaviour = behaviour
+    httpd = TestHTTPServer((host, port), HelloWorldHandler)
+    if keyfile and certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
     httpd.serve_forever()
     logger.info("Stopping HTTP server")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="HTTP test server")
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--keyfile', type=str, default="/app/key.pem", help="TLS key (empty to serve plain HTTP)")
+    parser.add_argument('--certfile', type=str, default="/app/certificate.pem", help="TLS certificate (empty to serve plain HTTP)")
+    stand_in.add_arguments(parser)
+    args = parser.parse_args()
+    logger.setLevel(args.log_level.upper())
     try:
-        run_server()
+        run_server(host=args.host, port=args.port, keyfile=args.keyfile, certfile=args.certfile,
+                   behaviour=stand_in.from_args(args))
     except KeyboardInterrupt:
         print("Shutting down HTTP server")
     sys.exit(0)
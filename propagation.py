@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import redis
+from scheduler import Schedule
+
+# field of a set hash holding its rdata
+RDATA = '_rdata'
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_propagation_redis():
+    """ Return the client of the Redis shared by all the sensors, None when PROPAGATION_REDIS_URL is not set """
+    global _client
+    url = os.getenv("PROPAGATION_REDIS_URL")
+    if not url:
+        return None
+    with _client_lock:
+        if _client is None:
+            _client = redis.Redis.from_url(url)
+        return _client
+
+
+def rdata_digest(answers):
+    return hashlib.sha256(json.dumps(sorted(answers)).encode()).hexdigest()[:16]
+
+
+def index_key(domain, record_type):
+    """ Sorted set of the appearances of the rdata sets of a domain and record type, scored by first observation """
+    return f"propagation:{domain}:{record_type}"
+
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class PropagationRecorder(object):
+    """ Timestamp the first observation of each rdata set by each sensor and source.
+
+    Each appearance of an rdata set is an event `<digest>@<first seen>`,
+    indexed in the sorted set `propagation:<domain>:<record type>`, so a set
+    coming back, e.g. after a rollback, is measured again. A source joins the
+    latest event of the set it answers that started after the event of its
+    previous answer, or starts a new one. Each event has a hash
+    `propagation:<domain>:<record type>:<event>` with one field per
+    `<region>|<sensor id>|<source>` holding the time it was first seen there,
+    written with HSETNX so the earliest observation wins. A source only
+    writes when its answers change, so steady checks cost nothing.
+    """
+    def __init__(self, monitor, redis_client, ttl=604800):
+        self.monitor = monitor
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.observer = f"{monitor.region or '-'}|{monitor.sensor_id}"
+        # {(record_type, source): (digest, event, first seen of the event)} last written
+        self.seen = {}
+
+    def join_event(self, index, digest, after, now):
+        """ Return (event, first seen) of the appearance of digest, the latest one started
+        since `after` or a new one, atomically so concurrent sensors join the same event """
+        def join(pipe):
+            for event, score in pipe.zrevrangebyscore(index, '+inf', after, withscores=True):
+                event = decode(event)
+                if event.split('@', 1)[0] == digest:
+                    return event, score
+            event = f"{digest}@{now:.3f}"
+            pipe.multi()
+            pipe.zadd(index, {event: now})
+            pipe.expire(index, self.ttl)
+            return event, now
+        return self.redis_client.transaction(join, index, value_from_callable=True)
+
+    def observe(self, answers):
+        """ Record answers ({(record_type, source): rdata list}) observed now """
+        now = time.time()
+        try:
+            pipe = None
+            for (record_type, source), rdata in answers.items():
+                digest = rdata_digest(rdata)
+                previous = self.seen.get((record_type, source))
+                if previous and previous[0] == digest:
+                    continue
+                index = index_key(self.monitor.domain, record_type)
+                event, first_seen = self.join_event(index, digest, previous[2] if previous else '-inf', now)
+                if pipe is None:
+                    pipe = self.redis_client.pipeline(transaction=False)
+                key = f"{index}:{event}"
+                pipe.hsetnx(key, RDATA, json.dumps(sorted(rdata)))
+                pipe.hsetnx(key, f"{self.observer}|{source}", now)
+                pipe.expire(key, self.ttl)
+                self.seen[(record_type, source)] = (digest, event, first_seen)
+            if pipe is not None:
+                pipe.execute()
+        except redis.RedisError as e:
+            # written again on the next observation
+            self.seen = {}
+            self.monitor.logger.warning(f"could not record propagation: {e}")
+
+
+def create_propagation_recorder(monitor):
+    redis_client = get_propagation_redis()
+    if redis_client is None:
+        return None
+    return PropagationRecorder(monitor, redis_client, ttl=int(os.getenv("PROPAGATION_TTL", 604800)))
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+def propagation_report(redis_client, domain, record_type, event=None, expected=None):
+    """ Propagation of an appearance of an rdata set (default the latest one) of a domain and record type.
+
+    `event` is an event or the digest of an rdata set for its latest appearance.
+    `expected` lists the observers (`<region>|<sensor id>|<source>`) that must
+    see the set for it to be seen everywhere, by default every observer of any
+    set of the domain and record type. Return None if nothing was recorded.
+    """
+    index = index_key(domain, record_type)
+    events = [decode(e) for e in redis_client.zrange(index, 0, -1)]
+    if event and '@' not in event:
+        events_of_set = [e for e in events if e.split('@', 1)[0] == event]
+        event = events_of_set[-1] if events_of_set else None
+    elif not event:
+        event = events[-1] if events else None
+    if event is None:
+        return None
+    pipe = redis_client.pipeline(transaction=False)
+    for e in events:
+        pipe.hkeys(f"{index}:{e}")
+    pipe.hgetall(f"{index}:{event}")
+    *all_fields, fields = pipe.execute()
+    if not fields:
+        return None
+    fields = {decode(k): decode(v) for k, v in fields.items()}
+    rdata = json.loads(fields.pop(RDATA, '[]'))
+    if expected is None:
+        expected = {decode(f) for keys in all_fields for f in keys} - {RDATA}
+    seen = {observer: float(t) for observer, t in fields.items()}
+    first_seen = min(seen.values())
+    delays = {observer: t - first_seen for observer, t in seen.items()}
+    missing = sorted(set(expected) - set(seen))
+    sorted_delays = sorted(delays.values())
+    regions = {}
+    for observer, delay in delays.items():
+        region = observer.split('|', 1)[0]
+        regions[region] = max(regions.get(region, 0), delay)
+    return {
+        'domain': domain,
+        'record_type': record_type,
+        'event': event,
+        'rdata': rdata,
+        'first_seen': first_seen,
+        'observers': len(seen),
+        'missing': missing,
+        # only known once every expected observer saw the set
+        'seen_everywhere': None if missing else max(sorted_delays),
+        'percentiles': {**{f"p{p}": percentile(sorted_delays, p) for p in (50, 90, 95, 99)}, 'max': max(sorted_delays)},
+        'regions': dict(sorted(regions.items())),
+        'delays': dict(sorted(delays.items(), key=lambda item: item[1])),
+    }
+
+
+def format_report(report):
+    lines = [f"{report['domain']} {report['record_type']} {report['event']}: {', '.join(report['rdata']) or '(none)'}",
+             f"first seen {time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(report['first_seen']))} "
+             f"by {report['observers']} observer(s)"]
+    if report['seen_everywhere'] is None:
+        lines.append(f"not seen yet by: {', '.join(report['missing'])}")
+    else:
+        lines.append(f"seen everywhere after {report['seen_everywhere']:.1f}s")
+    lines.append(" ".join(f"{p}={v:.1f}s" for p, v in report['percentiles'].items()))
+    for region, delay in report['regions'].items():
+        lines.append(f"  region {region}: {delay:.1f}s")
+    for observer, delay in report['delays'].items():
+        lines.append(f"    {observer}: +{delay:.1f}s")
+    return "\n".join(lines)
+
+
+def watch(domain, resolvers=None, record_types='A', interval=1, duration=600, expect=None, timeout=5):
+    """ Poll every resolver every `interval` seconds for `duration` seconds, or until
+    all of them answer every rdata of `expect`, recording the answers as they change """
+    from dns_monitor import DNSRecordMonitor
+    monitor = DNSRecordMonitor(domain, resolvers, record_types, timeout=timeout, fan_out=True)
+    if monitor.propagation is None:
+        raise ValueError("PROPAGATION_REDIS_URL is required")
+    expect = {x.strip() for x in expect.split(',') if x.strip()} if expect else None
+    deadline = time.monotonic() + duration
+    schedule = Schedule(interval)
+    while time.monotonic() < deadline:
+        monitor.source_records = {}
+        monitor.resolve(monitor.record_types)
+        if expect:
+            pending = [address for address in monitor.resolvers
+                       if not expect <= set(answer for answers in monitor.source_records.get(address, {}).values() for answer in answers)]
+            if not pending:
+                monitor.logger.info(f"every resolver answers {', '.join(sorted(expect))}")
+                return True
+            monitor.logger.info(f"waiting for {', '.join(sorted(pending))}")
+        schedule.advance()
+        schedule.sleep()
+    return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how long DNS changes take to propagate, see PROPAGATION_REDIS_URL")
+    commands = parser.add_subparsers(dest='command', required=True)
+    watch_parser = commands.add_parser('watch', help='poll fast after a known change, run on every sensor')
+    watch_parser.add_argument('--domain', type=str, help='Domain to watch', required=True)
+    watch_parser.add_argument('--resolvers', type=str, help="DNS resolvers addresses (comma separated list). Default 208.67.222.222,208.67.220.220.", default=None)
+    watch_parser.add_argument('--record_types', type=str, help='DNS record types to watch (comma separated list). Default A.', default='A')
+    watch_parser.add_argument('--interval', type=float, help='seconds between polls (default 1)', default=1)
+    watch_parser.add_argument('--duration', type=float, help='stop after N seconds (default 600)', default=600)
+    watch_parser.add_argument('--expect', type=str, help='stop once every resolver answers these rdata (comma separated list)', default=None)
+    watch_parser.add_argument('--timeout', type=float, help='deadline in seconds for each poll (default 5)', default=5)
+    report_parser = commands.add_parser('report', help='propagation delays of an appearance of an rdata set')
+    report_parser.add_argument('--domain', type=str, help='Domain', required=True)
+    report_parser.add_argument('--record_type', type=str, help='DNS record type (default A)', default='A')
+    report_parser.add_argument('--event', type=str, help='appearance of an rdata set, or digest of the set for its latest one (default the latest one)', default=None)
+    report_parser.add_argument('--expected', type=str, help='observers that must see the set (comma separated list, default every known one)', default=None)
+    report_parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    if args.command == 'watch':
+        try:
+            sys.exit(0 if watch(args.domain.lower(), args.resolvers, args.record_types, args.interval, args.duration,
+                                args.expect, args.timeout) else 1)
+        except KeyboardInterrupt:
+            sys.exit(1)
+    redis_client = get_propagation_redis()
+    if redis_client is None:
+        parser.error("PROPAGATION_REDIS_URL is required")
+    expected = args.expected.split(',') if args.expected else None
+    report = propagation_report(redis_client, args.domain.lower().strip(), args.record_type, args.event, expected)
+    if report is None:
+        print("nothing recorded")
+        sys.exit(1)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    sys.exit(0)
@@ -0,0 +1,30 @@
+# RDAP base URLs by TLD, from the IANA bootstrap registry (https://data.iana.org/rdap/dns.json).
+# Set RDAP_BOOTSTRAP_FILE to a copy of dns.json to use the complete, up-to-date registry instead.
+RDAP_SERVERS = {
+    "com": "https://rdap.verisign.com/com/v1/",
+    "net": "https://rdap.verisign.com/net/v1/",
+    "cc": "https://tld-rdap.verisign.com/cc/v1/",
+    "tv": "https://tld-rdap.verisign.com/tv/v1/",
+    "name": "https://tld-rdap.verisign.com/name/v1/",
+    "org": "https://rdap.publicinterestregistry.org/rdap/",
+    "info": "https://rdap.identitydigital.services/rdap/",
+    "io": "https://rdap.identitydigital.services/rdap/",
+    "mobi": "https://rdap.identitydigital.services/rdap/",
+    "pro": "https://rdap.identitydigital.services/rdap/",
+    "app": "https://pubapi.registry.google/rdap/",
+    "dev": "https://pubapi.registry.google/rdap/",
+    "page": "https://pubapi.registry.google/rdap/",
+    "how": "https://pubapi.registry.google/rdap/",
+    "xyz": "https://rdap.centralnic.com/xyz/",
+    "online": "https://rdap.centralnic.com/online/",
+    "site": "https://rdap.centralnic.com/site/",
+    "store": "https://rdap.centralnic.com/store/",
+    "tech": "https://rdap.centralnic.com/tech/",
+    "fr": "https://rdap.nic.fr/",
+    "re": "https://rdap.nic.fr/",
+    "pm": "https://rdap.nic.fr/",
+    "nl": "https://rdap.sidn.nl/",
+    "uk": "https://rdap.nominet.uk/uk/",
+    "br": "https://rdap.registro.br/",
+    "ca": "https://rdap.ca.fury.ca/rdap/",
+}
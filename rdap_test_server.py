@@ -0,0 +1,141 @@
+import sys
+import json
+import time
+import string
+import hashlib
+import logging
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import stand_in
+
+STATUSES = ['client delete prohibited', 'client transfer prohibited', 'client update prohibited',
+            'server delete prohibited', 'server transfer prohibited', 'active']
+
+# held open without answer for injected timeouts
+TIMEOUT_HOLD = 120
+
+logger = logging.getLogger("RDAPTestServer")
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+fh = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(fh)
+logger.addHandler(ch)
+
+
+def random_name(rng):
+    return "".join(rng.sample(string.ascii_lowercase, rng.randint(3, 12)))
+
+
+def generate_domain(domain, rng):
+    """ RDAP domain object with a few fields randomized """
+    registrar = random_name(rng)
+    return {
+        'objectClassName': 'domain',
+        'rdapConformance': ['rdap_level_0'],
+        'ldhName': domain,
+        'handle': f"{rng.randint(1, 10 ** 9)}_DOMAIN_DUMMY",
+        'port43': f"whois.{registrar}.dummy",
+        'status': sorted(rng.sample(STATUSES, rng.randint(1, 3))),
+        'events': [
+            {'eventAction': 'registration', 'eventDate': '2011-04-17T05:37:16Z'},
+            {'eventAction': 'expiration', 'eventDate': f"20{rng.randint(30, 80)}-04-17T05:37:16Z"},
+            {'eventAction': 'last changed', 'eventDate': f"2024-01-{rng.randint(1, 28):02d}T19:20:52Z"},
+        ],
+        'entities': [{
+            'objectClassName': 'entity',
+            'roles': ['registrar'],
+            'publicIds': [{'type': 'IANA Registrar ID', 'identifier': str(rng.randint(1, 5000))}],
+            'vcardArray': ['vcard', [['version', {}, 'text', '4.0'], ['fn', {}, 'text', registrar.upper()],
+                                     ['url', {}, 'uri', f"https://{registrar}.dummy"]]],
+            'entities': [{
+                'objectClassName': 'entity',
+                'roles': ['abuse'],
+                'vcardArray': ['vcard', [['version', {}, 'text', '4.0'], ['fn', {}, 'text', 'Abuse'],
+                                         ['email', {}, 'text', f"abuse@{registrar}.dummy"],
+                                         ['tel', {'type': 'voice'}, 'uri', f"tel:+1.{rng.randint(10 ** 9, 10 ** 10 - 1)}"]]],
+            }],
+        }],
+        'nameservers': [{'objectClassName': 'nameserver', 'ldhName': f"ns{i}.{random_name(rng)}.dummy"}
+                        for i in range(rng.randint(1, 4))],
+        'secureDNS': {'delegationSigned': rng.random() < 0.5},
+    }
+
+
+class RDAPTestServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # allow a deep backlog of pending connections
+    request_queue_size = 4096
+
+
+class RDAPHandler(BaseHTTPRequestHandler):
+    behaviour = stand_in.StandInBehaviour()
+    max_age = 0
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, code, document, headers=None):
+        body = json.dumps(document).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/rdap+json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        if not path.startswith('/domain/'):
+            self.send_json(404, {'errorCode': 404, 'title': 'Not Found'})
+            return
+        domain = path[len('/domain/'):].lower()
+        fault, rng = self.behaviour.query(domain)
+        delay = self.behaviour.delay()
+        if delay:
+            time.sleep(delay)
+        if fault == 'timeout':
+            time.sleep(TIMEOUT_HOLD)
+            self.close_connection = True
+            return
+        if fault == 'error':
+            self.send_json(500, {'errorCode': 500, 'title': 'Internal Server Error'})
+            return
+        document = generate_domain(domain, rng)
+        etag = '"' + hashlib.sha256(json.dumps(document, sort_keys=True).encode()).hexdigest()[:16] + '"'
+        headers = {'ETag': etag}
+        if self.max_age:
+            headers['Cache-Control'] = f"max-age={self.max_age}"
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_json(200, document, headers)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def run_server(host='127.0.0.1', port=7780, behaviour=None, max_age=0):
+    logger.info(f"Starting up RDAP server on {host} port {port}")
+    if behaviour:
+        RDAPHandler.behaviour = behaviour
+    RDAPHandler.max_age = max_age
+    httpd = RDAPTestServer((host, port), RDAPHandler)
+    httpd.serve_forever()
+    logger.info("Stopping RDAP server")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="RDAP test server")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7780)
+    parser.add_argument('--max_age', type=int, default=0, help='Cache-Control max-age of the answers (default none)')
+    stand_in.add_arguments(parser)
+    args = parser.parse_args()
+    logger.setLevel(args.log_level.upper())
+    try:
+        run_server(host=args.host, port=args.port, behaviour=stand_in.from_args(args), max_age=args.max_age)
+    except KeyboardInterrupt:
+        print("Shutting down RDAP server")
+    sys.exit(0)
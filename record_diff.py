@@ -0,0 +1,88 @@
+class Change(object):
+    """ A single change between two record sets, at the value level. """
+    ADDED = 'added'
+    REMOVED = 'removed'
+    MODIFIED = 'modified'
+
+    __slots__ = ('kind', 'key', 'old', 'new')
+
+    def __init__(self, kind, key, old=None, new=None):
+        self.kind = kind
+        self.key = key
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return "Change(kind=%s, key=%s, old=%r, new=%r)" % (self.kind, self.key, self.old, self.new)
+
+    def __str__(self):
+        if self.kind == self.ADDED:
+            return f"{self.key} -> record added: {self.new}"
+        if self.kind == self.REMOVED:
+            return f"{self.key} -> record removed: {self.old}"
+        return f"{self.key} -> record changed: {self.old} -> {self.new}"
+
+    def __eq__(self, other):
+        return isinstance(other, Change) and self.to_tuple() == other.to_tuple()
+
+    def __hash__(self):
+        return hash(self.to_tuple())
+
+    def to_tuple(self):
+        return (self.kind, self.key, self.old, self.new)
+
+    def to_dict(self):
+        d = {'kind': self.kind, 'key': self.key}
+        if self.kind != self.ADDED:
+            d['old'] = self.old
+        if self.kind != self.REMOVED:
+            d['new'] = self.new
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['kind'], d['key'], old=d.get('old'), new=d.get('new'))
+
+
+def diff_records(old_records, new_records):
+    """ Return the changes turning old_records into new_records.
+
+    Both arguments map a key (record type, WHOIS field...) to a list of values.
+    Values are compared as sets, so each added or removed value is its own
+    change; a key holding a single value on both sides that changed is
+    reported as one modified change instead of a removal and an addition.
+    """
+    changes = []
+    for key in sorted(old_records.keys() | new_records.keys()):
+        old_values = old_records.get(key, [])
+        new_values = new_records.get(key, [])
+        if len(old_values) == 1 and len(new_values) == 1:
+            if old_values[0] != new_values[0]:
+                changes.append(Change(Change.MODIFIED, key, old=old_values[0], new=new_values[0]))
+            continue
+        old_set = set(old_values)
+        new_set = set(new_values)
+        if old_set == new_set:
+            continue
+        for value in dict.fromkeys(old_values):
+            if value not in new_set:
+                changes.append(Change(Change.REMOVED, key, old=value))
+        for value in dict.fromkeys(new_values):
+            if value not in old_set:
+                changes.append(Change(Change.ADDED, key, new=value))
+    return changes
+
+
+
+def apply_changes(records, changes):
+    """ Return a copy of records with the given changes applied """
+    records = {k: list(v) for k, v in records.items()}
+    for change in changes:
+        values = records.setdefault(change.key, [])
+        if change.kind in (Change.REMOVED, Change.MODIFIED) and change.old in values:
+            values.remove(change.old)
+        if change.kind in (Change.ADDED, Change.MODIFIED):
+            values.append(change.new)
+        if not values:
+            del records[change.key]
+    return records
@@ -2,6 +2,7 @@ import sys
 import subprocess
 import time
 import argparse
+from utils import str2bool
 
 
 class Command(object):
@@ -31,18 +32,30 @@ class Runner(object):
         self.parse_options()
 
     def parse_options(self):
-        parser = argparse.ArgumentParser(description="Command line argument parser")
+        parser = argparse.ArgumentParser(description="Command line argument parser",
+                                         epilog='With CONSENSUS_REDIS_URL set to a Redis shared by every sensor, a change is only alerted once CONSENSUS_QUORUM (default 2) regions observe it, '
+                                                'a single alert per change whatever the number of sensors (CONSENSUS_WINDOW, default 600 seconds), observations older than CONSENSUS_MAX_AGE (default 3600) seconds do not count. '
+                                                'With PROPAGATION_REDIS_URL set to a Redis shared by every sensor, the time each DNS source first answers new records is kept for PROPAGATION_TTL (default 604800) seconds, see python3 propagation.py report --help.')
         # Adding the --whois argument
         parser.add_argument('--whois', action='append',
-                            help='Information for WHOIS query. Can be specified multiple times. Format: --whois=\'domain=<DOMAIN>;server=<OPTIONAL>;timeout=<OPTIONAL>;pause=<OPTIONAL>\'. Default WHOIS server is selected if not specified. Default WHOIS query timeout is 30 seconds. Default pause between each query is 300 seconds.')
+                            help='Information for WHOIS query. Can be specified multiple times. Format: --whois=\'domain=<DOMAIN>;server=<OPTIONAL>;timeout=<OPTIONAL>;backend=<OPTIONAL>;rdap_server=<OPTIONAL>;follow_referrals=<OPTIONAL>;pause=<OPTIONAL>\'. Default WHOIS server is selected if not specified, it can be given as host:port. Default WHOIS query timeout is 30 seconds. Default backend is whois21, set it to native to use the built-in asyncio WHOIS client (awaited directly by the async engine, rate limited with WHOIS_QPS and WHOIS_BURST) or to rdap to query the RDAP server of the TLD (or rdap_server). Default follow_referrals is false, set it to true to query the registrar WHOIS server given by the registry. Default pause between each query is 300 seconds.')
         # Adding the --dns argument
         parser.add_argument('--dns', action='append', 
-                            help='Information for DNS query. Can be specified multiple times. Format: --dns=\'domain=<DOMAIN>;resolvers=<OPTIONAL>;record_types=<OPTIONAL>;pause=<OPTIONAL>\'. Default resolvers are used if not specified (208.67.222.222,208.67.220.220). Default record types are A,AAAA,MX,NS,TXT,CNAME,SOA. Default pause between each query is 60 seconds.')
+                            help='Information for DNS query. Can be specified multiple times. Format: --dns=\'domain=<DOMAIN>;resolvers=<OPTIONAL>;record_types=<OPTIONAL>;timeout=<OPTIONAL>;soa_gate=<OPTIONAL>;full_sweep_interval=<OPTIONAL>;adaptive=<OPTIONAL>;min_pause=<OPTIONAL>;max_pause=<OPTIONAL>;burst_duration=<OPTIONAL>;authoritative=<OPTIONAL>;fan_out=<OPTIONAL>;pause=<OPTIONAL>\'. Default resolvers are used if not specified (208.67.222.222,208.67.220.220). Default record types are A,AAAA,MX,NS,TXT,CNAME,SOA. Default timeout for a whole check is 10 seconds. Default soa_gate is false, set it to true to only resolve every record type when the SOA serial changed. Default full_sweep_interval is 3600 seconds. Default adaptive is false, set it to true to schedule the next check from the TTL of the answers, between min_pause (default 10 seconds) and max_pause (default 10 times the pause) seconds, and every min_pause seconds for burst_duration (default 300) seconds after a change. Default authoritative is false, set it to true to query the authoritative servers of the zone directly. Default fan_out is false, set it to true to ask every resolver concurrently and report disagreements. Default pause between each query is 60 seconds.')
         # Adding the --http argument
         parser.add_argument('--http', action='append', 
-                            help='Information for HTTP query. Can be specified multiple times. Format: --http=\'url=<URL>;method=<OPTIONAL>;timeout=<OPTIONAL>;connect_timeout=<OPTIONAL>;payload=<OPTIONAL>;headers=<OPTIONAL>;verify_ssl=<OPTIONAL>;>pause=<OPTIONAL>\'. Default method is GET. Default timeout is 15 seconds. Default connect_timeout is 5 seconds. Default payload is empty. Default headers are empty. Default verify_ssl is true. Default pause between each query is 60 seconds.')
+                            help='Information for HTTP query. Can be specified multiple times. Format: --http=\'url=<URL>;method=<OPTIONAL>;timeout=<OPTIONAL>;connect_timeout=<OPTIONAL>;payload=<OPTIONAL>;headers=<OPTIONAL>;verify_ssl=<OPTIONAL>;conditional=<OPTIONAL>;hash_body=<OPTIONAL>;max_bytes=<OPTIONAL>;pause=<OPTIONAL>\'. Default method is GET. Default timeout is 15 seconds. Default connect_timeout is 5 seconds. Default payload is empty. Default headers are empty. Default verify_ssl is true. Default conditional is false, set it to true to revalidate with ETag/Last-Modified. Default hash_body is false, set it to true to detect changes on the SHA-256 of the whole body. Default max_bytes is 0 (whole body). Default pause between each query is 60 seconds.')
 
         parser.add_argument("--slack_webhook_url", help="Slack webhook url (default disabled).", default='')
+        parser.add_argument('--engine', choices=['process', 'async'], default='process',
+                            help='Execution engine. "process" starts one python process per target, "async" runs every target in a single event loop (default process).')
+        parser.add_argument('--whois_concurrency', type=int, default=None, help='Maximum concurrent WHOIS checks with the async engine (default 10).')
+        parser.add_argument('--dns_concurrency', type=int, default=None, help='Maximum concurrent DNS checks with the async engine (default 100).')
+        parser.add_argument('--http_concurrency', type=int, default=None, help='Maximum concurrent HTTP checks with the async engine (default 50).')
+        parser.add_argument('--dns_notify_port', type=int, default=None, help='Check the DNS targets of a zone when a DNS NOTIFY for it is received on this port, with the async engine (default disabled). Only the targets with authoritative=true are triggered, the others keep polling every pause.')
+        parser.add_argument('--dns_notify_primaries', type=str, default=None, help='Addresses or networks allowed to send DNS NOTIFY (comma separated list).')
+        parser.add_argument('--dns_safety_pause', type=float, default=3600, help='With --dns_notify_port, seconds between the checks of the DNS targets without NOTIFY (default 3600).')
+        parser.add_argument('--metrics_port', type=int, default=None, help='Serve Prometheus metrics on this port with the async engine (default disabled).')
         parser.add_argument('--python_exe', help='Path to python executable', default='python3')
         parser.add_argument('--whois_script', help='Path to whois script', default=self.WHOIS_SCRIPT)
         parser.add_argument('--dns_script', help='Path to dns script', default=self.DNS_SCRIPT)
@@ -57,94 +70,133 @@ class Runner(object):
     def _strip_and_split_args(self, args):
         return args.strip("'").strip('"').split(';')
 
-    def spawn_whois_command(self, args):
+    def parse_whois_args(self, args):
         # args format is domain=<domain>;server=<optional>;timeout=30
         options = self._strip_and_split_args(args)
-        domain = ''
-        server = ''
-        timeout = '30'
-        pause = '300'
+        spec = {'domain': '', 'server': '', 'timeout': '30', 'backend': 'whois21', 'rdap_server': '',
+                'follow_referrals': 'False',
+                'pause': '300'}
         for option in options:
             key, value = option.split('=')
             key = key.strip()
             value = value.strip()
-            if key == 'domain':
-                domain = value
-            elif key == 'server':
-                server = value
-            elif key == 'timeout':
-                timeout = value
-            elif key == 'pause':
-                pause = value
+            if key in spec:
+                spec[key] = value
+        return spec
+
+    def parse_dns_args(self, args):
+        # args format is domain=<domain>;resolvers=<resolvers>;record_types=<record_types>
+        options = self._strip_and_split_args(args)
+        spec = {'domain': '', 'resolvers': '', 'record_types': '', 'timeout': '10', 'soa_gate': 'False',
+                'full_sweep_interval': '3600', 'adaptive': 'False', 'min_pause': '10', 'max_pause': '0',
+                'burst_duration': '300', 'authoritative': 'False', 'fan_out': 'False',
+                'pause': '120'}
+        for option in options:
+            key, value = option.split('=')
+            if key in spec:
+                spec[key] = value
+        return spec
+
+    def parse_http_args(self, args):
+        # args format is url=<url>;method=<method>;timeout=<timeout>;connect_timeout=<connect_timeout>;payload=<payload>;headers=<headers>;verify_ssl=<verify_ssl>;pause=<pause>
+        options = self._strip_and_split_args(args)
+        spec = {'url': '', 'method': 'GET', 'timeout': '15', 'connect_timeout': '5', 'payload': '',
+                'headers': '', 'verify_ssl': 'True', 'conditional': 'False',
+                'hash_body': 'False', 'max_bytes': '0', 'pause': '60'}
+        for option in options:
+            key, value = option.split('=')
+            if key in spec:
+                spec[key] = value
+        return spec
+
+    def spawn_whois_command(self, args):
+        spec = self.parse_whois_args(args)
         # Run the whois script
         p = Command(self.python_exe, self.whois_script, 
-                          ["--domain", domain, "--whois_server", server, "--whois_timeout", timeout, 
-                           "--slack_webhook_url", self.args.slack_webhook_url, "--pause", pause])
+                          ["--domain", spec['domain'], "--whois_server", spec['server'], "--whois_timeout", spec['timeout'], 
+                           "--backend", spec['backend'], "--rdap_server", spec['rdap_server'],
+                           "--follow_referrals", spec['follow_referrals'],
+                           "--slack_webhook_url", self.args.slack_webhook_url, "--pause", spec['pause']])
         p.run()
         self.processes.append(p)
 
     def spawn_dns_command(self, args):
-        # args format is domain=<domain>;resolvers=<resolvers>;record_types=<record_types>
-        options = self._strip_and_split_args(args)
-        domain = ''
-        resolvers = ''
-        record_types = ''
-        pause = '120'
-        for option in options:
-            key, value = option.split('=')
-            if key == 'domain':
-                domain = value
-            elif key == 'resolvers':
-                resolvers = value
-            elif key == 'record_types':
-                record_types = value
-            elif key == 'pause':
-                pause = value
+        spec = self.parse_dns_args(args)
         # Run the dns script
         p = Command(self.python_exe, self.dns_script, 
-                          ["--domain", domain, "--resolvers", resolvers, "--record_types", record_types,
-                           "--slack_webhook_url", self.args.slack_webhook_url, "--pause", pause])
+                          ["--domain", spec['domain'], "--resolvers", spec['resolvers'], "--record_types", spec['record_types'], "--timeout", spec['timeout'],
+                           "--soa_gate", spec['soa_gate'], "--full_sweep_interval", spec['full_sweep_interval'],
+                           "--adaptive", spec['adaptive'], "--min_pause", spec['min_pause'], "--max_pause", spec['max_pause'],
+                           "--burst_duration", spec['burst_duration'], "--authoritative", spec['authoritative'],
+                           "--fan_out", spec['fan_out'],
+                           "--slack_webhook_url", self.args.slack_webhook_url, "--pause", spec['pause']])
         p.run()
         self.processes.append(p)
 
     def spawn_http_command(self, args):
-        # args format is url=<url>;method=<method>;timeout=<timeout>;connect_timeout=<connect_timeout>;payload=<payload>;headers=<headers>;verify_ssl=<verify_ssl>;pause=<pause>
-        options = self._strip_and_split_args(args)
-        url = ''
-        method = 'GET'
-        timeout = '15'
-        connect_timeout = '5'
-        payload = ''
-        headers = ''
-        verify_ssl = 'True'
-        pause = '60'
-        for option in options:
-            key, value = option.split('=')
-            if key == 'url':
-                url = value
-            elif key == 'method':
-                method = value
-            elif key == 'timeout':
-                timeout = value
-            elif key == 'connect_timeout':
-                connect_timeout = value
-            elif key == 'payload':
-                payload = value
-            elif key == 'headers':
-                headers = value
-            elif key == 'verify_ssl':
-                verify_ssl = value
-            elif key == 'pause':
-                pause = value
+        spec = self.parse_http_args(args)
         # Run the http script
         p = Command(self.python_exe, self.http_script, 
-                          ["--url", url, "--method", method, "--timeout", timeout, "--connect_timeout", connect_timeout,
-                           "--payload", payload, "--headers", headers, "--verify_ssl", verify_ssl,
-                           "--slack_webhook_url", self.args.slack_webhook_url, "--pause", pause])
+                          ["--url", spec['url'], "--method", spec['method'], "--timeout", spec['timeout'], "--connect_timeout", spec['connect_timeout'],
+                           "--payload", spec['payload'], "--headers", spec['headers'], "--verify_ssl", spec['verify_ssl'],
+                           "--conditional", spec['conditional'], "--hash_body", spec['hash_body'], "--max_bytes", spec['max_bytes'],
+                           "--slack_webhook_url", self.args.slack_webhook_url, "--pause", spec['pause']])
         p.run()
         self.processes.append(p)
 
+    def build_async_engine(self):
+        from async_engine import AsyncEngine
+        engine = AsyncEngine(self.args.slack_webhook_url,
+                             concurrency={'whois': self.args.whois_concurrency,
+                                          'dns': self.args.dns_concurrency,
+                                          'http': self.args.http_concurrency})
+        if self.args.whois:
+            from whois_monitor import WHOISMonitor
+            for args in self.args.whois:
+                spec = self.parse_whois_args(args)
+                monitor = WHOISMonitor(spec['domain'], whois_server=spec['server'], whois_timeout=int(spec['timeout']),
+                                       slack_webhook_url=self.args.slack_webhook_url, backend=spec['backend'],
+                                       follow_referrals=str2bool(spec['follow_referrals']),
+                                       rdap_server=spec['rdap_server'] or None)
+                engine.add('whois', monitor, int(spec['pause']))
+        if self.args.dns:
+            from dns_monitor import DNSRecordMonitor
+            listener = None
+            if self.args.dns_notify_port:
+                from dns_notify_listener import NotifyListener
+                listener = NotifyListener(self.args.dns_notify_primaries, port=self.args.dns_notify_port,
+                                          safety_pause=self.args.dns_safety_pause)
+            for args in self.args.dns:
+                spec = self.parse_dns_args(args)
+                monitor = DNSRecordMonitor(spec['domain'], spec['resolvers'], spec['record_types'],
+                                           slack_webhook_url=self.args.slack_webhook_url, timeout=float(spec['timeout']),
+                                           soa_gate=str2bool(spec['soa_gate']),
+                                           full_sweep_interval=float(spec['full_sweep_interval']),
+                                           adaptive=str2bool(spec['adaptive']), min_pause=float(spec['min_pause']),
+                                           max_pause=float(spec['max_pause']) or None,
+                                           burst_duration=float(spec['burst_duration']),
+                                           authoritative=str2bool(spec['authoritative']),
+                                           fan_out=str2bool(spec['fan_out']))
+                engine.add('dns', monitor, int(spec['pause']))
+                if listener:
+                    listener.add(monitor)
+            if listener:
+                listener.start()
+        if self.args.http:
+            from http_monitor import HTTPMonitor
+            for args in self.args.http:
+                spec = self.parse_http_args(args)
+                monitor = HTTPMonitor(spec['url'], method=spec['method'], payload=spec['payload'], headers=spec['headers'],
+                                      connect_timeout=int(spec['connect_timeout']), timeout=int(spec['timeout']),
+                                      verify_ssl=str2bool(spec['verify_ssl']),
+                                      slack_webhook_url=self.args.slack_webhook_url, conditional=str2bool(spec['conditional']),
+                                      hash_body=str2bool(spec['hash_body']), max_bytes=int(spec['max_bytes']) or None)
+                engine.add('http', monitor, int(spec['pause']))
+        return engine
+
     def start(self):
+        if self.args.dns_notify_port:
+            print("--dns_notify_port requires --engine async, ignored.")
         if self.args.whois:
             for args in self.args.whois:
                 self.spawn_whois_command(args)
@@ -175,6 +227,14 @@ class Runner(object):
         return 0
 
     def serve_forever(self):
+        if self.args.engine == 'async':
+            engine = self.build_async_engine()
+            if self.args.metrics_port:
+                from metrics import start_metrics_server
+                start_metrics_server(self.args.metrics_port)
+            if engine.serve_forever() != 0:
+                sys.exit(1)
+            return
         if self.start() != 0:
             sys.exit(1)
         if self.wait() != 0:
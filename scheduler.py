@@ -0,0 +1,69 @@
+import os
+import math
+import time
+import random
+import hashlib
+
+
+class Schedule(object):
+    """ Absolute deadlines of a periodic check.
+
+    Deadlines are multiples of the interval shifted by an offset derived from a
+    hash of the target key, so targets sharing an interval are spread across it
+    instead of firing in lockstep, and the period does not drift with the
+    duration of the checks. Each wake-up is delayed by a random jitter of up to
+    `jitter` times the interval. Deadlines that have already passed when the
+    previous check returns are skipped rather than run late. The first check
+    runs right away, the offset applies from the second one. An interval of 0
+    runs the checks back to back.
+
+    Deadlines follow the monotonic `clock`, so steps of the system clock neither
+    skip nor repeat checks. Only the offset is placed on the `wall_clock`, once,
+    so that the slots of a key are the same for every process.
+    """
+    def __init__(self, interval, key='', jitter=0.0, clock=time.monotonic, wall_clock=time.time):
+        if interval < 0:
+            raise ValueError("interval must not be negative")
+        self.interval = float(interval)
+        self.jitter = float(jitter)
+        self.clock = clock
+        self.wall_clock = wall_clock
+        digest = hashlib.sha256(str(key).encode()).digest()
+        self.phase = int.from_bytes(digest[:8], 'big') / 2.0 ** 64
+        self.deadline = None
+        self.aligned = False
+        self.wakeup = None
+
+    def advance(self, interval=None):
+        """ Move to the next deadline, return how many deadlines were skipped because they already passed """
+        if interval:
+            self.interval = float(interval)
+        now = self.clock()
+        if self.deadline is None or self.interval == 0:
+            self.deadline = self.wakeup = now
+            return 0
+        if not self.aligned:
+            # last slot of the phase before the first check, the next one follows it
+            offset = self.phase * self.interval
+            wall = self.deadline + self.wall_clock() - now
+            self.deadline += math.floor((wall - offset) / self.interval) * self.interval + offset - wall
+            self.aligned = True
+        skipped = 0
+        self.deadline += self.interval
+        if self.deadline < now:
+            skipped = math.ceil((now - self.deadline) / self.interval)
+            self.deadline += skipped * self.interval
+        self.wakeup = self.deadline + random.uniform(0, self.jitter * self.interval)
+        return skipped
+
+    def delay(self):
+        """ Seconds until the current deadline """
+        return max(0.0, self.wakeup - self.clock())
+
+    def sleep(self):
+        time.sleep(self.delay())
+
+
+def create_schedule(interval, key=''):
+    jitter = float(os.getenv("SCHEDULE_JITTER", 0.1))
+    return Schedule(interval, key=key, jitter=jitter)
@@ -0,0 +1,63 @@
+import random
+import threading
+
+
+class StandInBehaviour(object):
+    """ Latency, failures and changes injected by the test servers.
+
+    Every answer is derived from a per-key random generator seeded with
+    (seed, key, version), and each query of a key bumps its version with
+    probability `change_rate`. With a fixed seed the answers of a key only
+    depend on how many times it was queried, whatever the concurrency.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, timeout_rate=0.0, change_rate=1.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.change_rate = change_rate
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def rng(self, *parts):
+        return random.Random(":".join(str(p) for p in (self.seed,) + parts))
+
+    def delay(self):
+        """ Seconds to wait before answering """
+        if self.jitter:
+            return self.latency + random.uniform(0, self.jitter)
+        return self.latency
+
+    def query(self, key):
+        """ Register a query of key, return (fault, rng) where fault is None, 'error' or 'timeout' """
+        with self.lock:
+            state = self.states.setdefault(key, [0, 0])
+            state[0] += 1
+            queries = state[0]
+            if queries > 1 and self.rng(key, 'change', queries).random() < self.change_rate:
+                state[1] += 1
+            version = state[1]
+        draw = self.rng(key, 'fault', queries).random()
+        if draw < self.timeout_rate:
+            fault = 'timeout'
+        elif draw < self.timeout_rate + self.error_rate:
+            fault = 'error'
+        else:
+            fault = None
+        return fault, self.rng(key, version)
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency added to each answer in seconds (default 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency of up to this many seconds (default 0)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of queries answered with an error (default 0)')
+    parser.add_argument('--timeout_rate', type=float, default=0.0, help='Fraction of queries never answered (default 0)')
+    parser.add_argument('--change_rate', type=float, default=1.0, help='Probability that an answer changes between two queries (default 1)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the generated answers (default random)')
+    parser.add_argument('--log_level', type=str, default='INFO', help='Log level (default INFO)')
+
+
+def from_args(args):
+    return StandInBehaviour(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            timeout_rate=args.timeout_rate, change_rate=args.change_rate, seed=args.seed)
@@ -0,0 +1,112 @@
+import logging
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import consensus
+from base_monitor import BaseMonitor
+from consensus import Consensus
+from record_diff import Change, diff_records
+
+D0 = {'A': ['10.0.0.1'], 'NS': ['ns1.dummy.net.', 'ns2.dummy.net.']}
+D1 = {'A': ['10.0.0.2'], 'NS': ['ns1.dummy.net.', 'ns2.dummy.net.']}
+D2 = {'A': ['10.0.0.2'], 'NS': ['ns1.dummy.net.', 'ns3.dummy.net.']}
+
+
+class Sensor(object):
+    """ A sensor of a region observing the records of the same target """
+    def __init__(self, redis_client, region):
+        self.monitor = SimpleNamespace(region=region, sensor_id=f"{region}-sensor", class_name='DNSRecordMonitor',
+                                       parameters={'domain': 'dummy.net'}, slack_webhook_url='https://hooks.slack.test',
+                                       logger=logging.getLogger(f"test_consensus.{region}"),
+                                       records_digest=BaseMonitor.records_digest, format_change=BaseMonitor.format_change)
+        self.consensus = Consensus(self.monitor, redis_client, quorum=2)
+        self.records = None
+
+    def observe(self, records):
+        """ Same arguments as BaseMonitor.monitor gives after detect_changes """
+        changes = diff_records(self.records or {}, records)
+        changed = self.records is not None and len(changes) > 0
+        self.records = records
+        return self.consensus.observe(BaseMonitor.records_digest(records), records, changed, changes)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ConsensusTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = mock.Mock()
+        patcher = mock.patch.object(consensus, 'get_dispatcher', return_value=self.dispatcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        redis_client = fakeredis.FakeRedis()
+        self.iad = Sensor(redis_client, 'fly.io/iad')
+        self.fra = Sensor(redis_client, 'fly.io/fra')
+        self.fra_other = Sensor(redis_client, 'fly.io/fra')
+
+    def alerts(self):
+        return [c.args[2] for c in self.dispatcher.notify.call_args_list]
+
+    def confirm(self, records):
+        """ Observe records from both regions, return whether each sensor alerted """
+        return [self.iad.observe(records), self.fra.observe(records)]
+
+    def test_first_records_are_not_alerted(self):
+        self.assertEqual(self.confirm(D0), [False, False])
+        self.assertEqual(self.alerts(), [])
+
+    def test_change_is_alerted_once_confirmed(self):
+        self.confirm(D0)
+        self.assertEqual(self.confirm(D1), [False, True])
+        self.assertEqual(len(self.alerts()), 1)
+        self.assertIn(BaseMonitor.format_change(Change(Change.MODIFIED, 'A', old='10.0.0.1', new='10.0.0.2')), self.alerts()[0])
+        # seen again by the first region, already confirmed
+        self.assertFalse(self.iad.observe(D1))
+        self.assertEqual(len(self.alerts()), 1)
+
+    def test_sensors_of_a_region_share_a_vote(self):
+        self.confirm(D0)
+        self.fra_other.observe(D0)
+        self.fra.observe(D1)
+        self.assertFalse(self.fra_other.observe(D1))
+        self.assertEqual(self.alerts(), [])
+        self.assertTrue(self.iad.observe(D1))
+
+    def test_regional_glitch_and_rollback_are_not_alerted(self):
+        self.confirm(D0)
+        self.assertFalse(self.iad.observe(D1))
+        self.assertFalse(self.iad.observe(D0))
+        self.assertFalse(self.fra.observe(D0))
+        self.assertEqual(self.alerts(), [])
+
+    def test_flip_flop_is_alerted_every_time(self):
+        self.confirm(D0)
+        for records in (D1, D0, D1):
+            self.assertEqual(self.confirm(records), [False, True])
+        self.assertEqual(len(self.alerts()), 3)
+
+    def test_changes_since_the_confirmed_records(self):
+        self.confirm(D0)
+        # the first region sees two changes before the other one catches up
+        self.assertFalse(self.iad.observe(D1))
+        self.assertFalse(self.iad.observe(D2))
+        self.assertTrue(self.fra.observe(D2))
+        self.assertFalse(self.iad.observe(D2))
+        alerts = self.alerts()
+        self.assertEqual(len(alerts), 1)
+        for change in diff_records(D0, D2):
+            self.assertIn(BaseMonitor.format_change(change), alerts[0])
+
+    def test_pending_changes_accumulate_from_the_first_one(self):
+        self.confirm(D0)
+        self.iad.observe(D1)
+        self.iad.observe(D2)
+        self.assertEqual(self.iad.consensus.pending, D0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import time
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from history import ChangeHistory
+from record_diff import diff_records
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class ChangeHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.redis_client = fakeredis.FakeRedis()
+
+    def create_history(self, checkpoint_interval):
+        return ChangeHistory(self.redis_client, 'DNSRecordMonitor::dummy:history', checkpoint_interval=checkpoint_interval)
+
+    def record(self, history, states):
+        """ Append each state as a cycle, return the time right after each of them """
+        times = []
+        previous = {}
+        for records in states:
+            history.append(diff_records(previous, records), records)
+            previous = records
+            times.append(time.time())
+            # one entry per millisecond at most, so that each time falls between two entries
+            time.sleep(0.005)
+        return times
+
+    def test_state_at_replays_the_deltas_after_the_checkpoint(self):
+        states = [{'A': [f'10.0.0.{i}'], 'NS': ['ns1.dummy.net.']} for i in range(7)]
+        history = self.create_history(checkpoint_interval=3)
+        times = self.record(history, states)
+        for t, records in zip(times, states):
+            self.assertEqual(history.state_at(t), records)
+        self.assertEqual(history.state_at(), states[-1])
+
+    def test_state_before_the_first_entry_is_unknown(self):
+        before = time.time() - 1
+        history = self.create_history(checkpoint_interval=3)
+        self.record(history, [{'A': ['10.0.0.1']}])
+        self.assertIsNone(history.state_at(before))
+
+    def test_checkpoint_further_than_a_page(self):
+        states = [{'A': [f'10.0.{i // 250}.{i % 250}']} for i in range(120)]
+        history = self.create_history(checkpoint_interval=1000)
+        previous = {}
+        for records in states:
+            history.append(diff_records(previous, records), records)
+            previous = records
+        self.assertEqual(history.state_at(), states[-1])
+
+    def test_new_process_writes_a_checkpoint(self):
+        states = [{'A': ['10.0.0.1']}, {'A': ['10.0.0.2']}, {'A': ['10.0.0.3']}]
+        self.record(self.create_history(checkpoint_interval=1000), states[:2])
+        history = self.create_history(checkpoint_interval=1000)
+        self.record(history, states[2:])
+        entries = self.redis_client.xrange(history.key)
+        self.assertEqual([b'snapshot' in fields for entry_id, fields in entries], [True, False, True])
+        self.assertEqual(history.state_at(), states[-1])
+
+    def test_changes_between_timestamps(self):
+        states = [{'A': ['10.0.0.1']}, {'A': ['10.0.0.2']}, {'A': ['10.0.0.3']}]
+        history = self.create_history(checkpoint_interval=3)
+        times = self.record(history, states)
+        changes = history.changes(start=times[0] + 0.001, end=times[2])
+        self.assertEqual([c for _, c in changes], [diff_records(states[0], states[1]), diff_records(states[1], states[2])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from record_diff import Change, apply_changes, diff_records
+
+
+class DiffRecordsTest(unittest.TestCase):
+    def test_same_records_in_another_order(self):
+        old = {'A': ['1.1.1.1', '2.2.2.2'], 'MX': ['10 mx1.dummy.net.']}
+        new = {'MX': ['10 mx1.dummy.net.'], 'A': ['2.2.2.2', '1.1.1.1']}
+        self.assertEqual(diff_records(old, new), [])
+
+    def test_single_value_is_modified(self):
+        changes = diff_records({'REGISTRAR': ['OLD']}, {'REGISTRAR': ['NEW']})
+        self.assertEqual(changes, [Change(Change.MODIFIED, 'REGISTRAR', old='OLD', new='NEW')])
+
+    def test_each_value_is_its_own_change(self):
+        changes = diff_records({'A': ['1.1.1.1', '2.2.2.2']}, {'A': ['2.2.2.2', '3.3.3.3', '4.4.4.4']})
+        self.assertEqual(changes, [Change(Change.REMOVED, 'A', old='1.1.1.1'),
+                                   Change(Change.ADDED, 'A', new='3.3.3.3'),
+                                   Change(Change.ADDED, 'A', new='4.4.4.4')])
+
+    def test_added_and_removed_keys(self):
+        changes = diff_records({'TXT': ['v=spf1 -all']}, {'AAAA': ['::1']})
+        self.assertEqual(changes, [Change(Change.ADDED, 'AAAA', new='::1'),
+                                   Change(Change.REMOVED, 'TXT', old='v=spf1 -all')])
+
+    def test_duplicate_values_are_reported_once(self):
+        changes = diff_records({'A': ['1.1.1.1', '1.1.1.1', '2.2.2.2']}, {'A': []})
+        self.assertEqual(changes, [Change(Change.REMOVED, 'A', old='1.1.1.1'),
+                                   Change(Change.REMOVED, 'A', old='2.2.2.2')])
+
+    def test_apply_changes_rebuilds_the_new_records(self):
+        old = {'A': ['1.1.1.1', '2.2.2.2'], 'NS': ['ns1.dummy.net.'], 'TXT': ['old']}
+        new = {'A': ['2.2.2.2', '3.3.3.3'], 'NS': ['ns2.dummy.net.'], 'MX': ['10 mx.dummy.net.']}
+        rebuilt = apply_changes(old, diff_records(old, new))
+        self.assertEqual({k: sorted(v) for k, v in rebuilt.items()}, new)
+        # the records given are left untouched
+        self.assertEqual(old['A'], ['1.1.1.1', '2.2.2.2'])
+
+    def test_change_round_trips_through_dict(self):
+        for change in (Change(Change.ADDED, 'A', new='1.1.1.1'), Change(Change.REMOVED, 'A', old='1.1.1.1'),
+                       Change(Change.MODIFIED, 'SOA', old='a', new='b')):
+            self.assertEqual(Change.from_dict(change.to_dict()), change)
+
+
+if __name__ == '__main__':
+    unittest.main()
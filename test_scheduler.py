@@ -0,0 +1,88 @@
+import unittest
+
+from scheduler import Schedule
+
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.wall = 1700000007.0
+
+    def create_schedule(self, interval, jitter=0.0):
+        schedule = Schedule(interval, key='dummy', jitter=jitter, clock=lambda: self.now, wall_clock=lambda: self.wall)
+        # slots at 5 seconds past each multiple of 10 seconds of the wall clock
+        schedule.phase = 0.5
+        return schedule
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.wall += seconds
+
+    def test_first_check_runs_right_away(self):
+        schedule = self.create_schedule(10)
+        self.assertEqual(schedule.advance(), 0)
+        self.assertEqual(schedule.delay(), 0)
+
+    def test_deadlines_follow_the_phase_without_drift(self):
+        schedule = self.create_schedule(10)
+        schedule.advance()
+        self.sleep(1)
+        self.assertEqual(schedule.advance(), 0)
+        # the wall clock reads ...08, the next slot is ...15
+        self.assertEqual(schedule.delay(), 7)
+        for _ in range(3):
+            self.sleep(schedule.delay() + 3)
+            self.assertEqual(schedule.advance(), 0)
+            self.assertEqual(schedule.delay(), 7)
+
+    def test_overrun_skips_the_deadlines_already_passed(self):
+        schedule = self.create_schedule(10)
+        schedule.advance()
+        schedule.advance()
+        # check started at the deadline, lasting 25 seconds
+        self.sleep(schedule.delay() + 25)
+        self.assertEqual(schedule.advance(), 2)
+        self.assertEqual(schedule.delay(), 5)
+
+    def test_wall_clock_steps_are_ignored(self):
+        schedule = self.create_schedule(10)
+        schedule.advance()
+        schedule.advance()
+        self.sleep(schedule.delay())
+        self.wall -= 3600
+        self.assertEqual(schedule.advance(), 0)
+        self.assertEqual(schedule.delay(), 10)
+
+    def test_pause_of_zero_runs_back_to_back(self):
+        schedule = self.create_schedule(0)
+        for _ in range(3):
+            self.assertEqual(schedule.advance(), 0)
+            self.assertEqual(schedule.delay(), 0)
+            self.sleep(2)
+
+    def test_interval_can_change(self):
+        schedule = self.create_schedule(10)
+        schedule.advance()
+        schedule.advance()
+        self.sleep(schedule.delay())
+        schedule.advance(30)
+        self.assertEqual(schedule.delay(), 30)
+
+    def test_jitter_delays_the_wakeup_only(self):
+        schedule = self.create_schedule(10, jitter=0.5)
+        schedule.advance()
+        schedule.advance()
+        for _ in range(20):
+            deadline = schedule.deadline
+            self.assertTrue(0 <= schedule.wakeup - deadline <= 5)
+            self.sleep(schedule.delay())
+            schedule.advance()
+            self.assertEqual(schedule.deadline, deadline + 10)
+
+    def test_negative_interval_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Schedule(-1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import json
+import unittest
+from unittest import mock
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import base_monitor
+from record_diff import Change
+from whois_monitor import WHOISMonitor, parse_whois_response, parse_rdap_response
+
+WHOIS_ANSWER = b"""Domain Name: DUMMY.NET
+Registry Domain ID: 123_DOMAIN_NET-VRSN
+Registrar WHOIS Server: whois.registrar.dummy
+Updated Date: 2024-01-05T19:20:52Z
+Creation Date: 2011-04-17T05:37:16Z
+Registry Expiry Date: 2030-04-17T05:37:16Z
+Registrar: %s
+Registrar IANA ID: 1234
+Domain Status: clientTransferProhibited https://icann.org/epp#clientTransferProhibited
+Domain Status: clientDeleteProhibited https://icann.org/epp#clientDeleteProhibited
+Name Server: NS1.DUMMY.NET
+Name Server: NS2.DUMMY.NET
+DNSSEC: unsigned
+"""
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class WHOISChangesTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(base_monitor, 'create_redis_client', lambda *args, **kwargs: fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.monitor = WHOISMonitor('dummy.net', whois_server='127.0.0.1:43')
+
+    def detect(self, records):
+        with mock.patch.object(self.monitor, 'fetch_new_records', return_value=records):
+            return self.monitor.detect_changes()
+
+    def test_parsed_fields_are_lists(self):
+        records = parse_whois_response(WHOIS_ANSWER % b"OLD REGISTRAR")
+        self.assertEqual(records['DOMAIN NAME'], ['DUMMY.NET'])
+        self.assertEqual(records['DOMAIN STATUS'], ['clientDeleteProhibited', 'clientTransferProhibited'])
+        self.assertTrue(all(isinstance(v, list) for v in records.values()))
+
+    def test_only_the_changed_field_is_reported(self):
+        self.detect(parse_whois_response(WHOIS_ANSWER % b"OLD REGISTRAR"))
+        changed, _, changes = self.detect(parse_whois_response(WHOIS_ANSWER % b"NEW REGISTRAR"))
+        self.assertTrue(changed)
+        self.assertEqual(changes, [Change(Change.MODIFIED, 'REGISTRAR', old='OLD REGISTRAR', new='NEW REGISTRAR')])
+        # the cached copy now matches the new answer
+        changed, _, changes = self.detect(parse_whois_response(WHOIS_ANSWER % b"NEW REGISTRAR"))
+        self.assertFalse(changed)
+        self.assertEqual(changes, [])
+
+    def test_legacy_cache_is_not_reported(self):
+        records = parse_whois_response(WHOIS_ANSWER % b"OLD REGISTRAR")
+        # raw whois21 data as cached by previous versions
+        legacy = {'domain name': 'dummy.net.', 'registrar': 'OLD REGISTRAR', 'name server': ['ns2.dummy.net', 'NS1.DUMMY.NET'],
+                  'domain status': ['clientTransferProhibited https://icann.org/epp#clientTransferProhibited',
+                                    'clientDeleteProhibited'],
+                  'updated date': '2024-01-05 19:20:52', 'creation date': '2011-04-17T05:37:16Z',
+                  'registry expiry date': '2030-04-17T05:37:16.0Z', 'registry domain id': '123_DOMAIN_NET-VRSN',
+                  'registrar whois server': 'whois.registrar.dummy', 'registrar iana id': '1234', 'dnssec': 'unsigned'}
+        self.monitor.redis_client.set(self.monitor.redis_key, json.dumps(legacy))
+        changed, _, changes = self.detect(records)
+        self.assertFalse(changed)
+        self.assertEqual(changes, [])
+
+    def test_rdap_fields_are_cached_as_lists(self):
+        rdap = {'objectClassName': 'domain', 'ldhName': 'dummy.net', 'handle': '123_DOMAIN_NET-VRSN',
+                'status': ['client transfer prohibited', 'active'],
+                'events': [{'eventAction': 'last changed', 'eventDate': '2024-01-05T19:20:52Z'}],
+                'entities': [{'roles': ['registrar'], 'vcardArray': ['vcard', [['fn', {}, 'text', 'OLD REGISTRAR']]]}],
+                'nameservers': [{'ldhName': 'NS2.DUMMY.NET'}, {'ldhName': 'ns1.dummy.net.'}]}
+        records = parse_rdap_response(rdap)
+        self.assertEqual(records, {'DOMAIN NAME': ['DUMMY.NET'], 'REGISTRY DOMAIN ID': ['123_DOMAIN_NET-VRSN'],
+                                   'UPDATED DATE': ['2024-01-05T19:20:52Z'], 'REGISTRAR': ['OLD REGISTRAR'],
+                                   'DOMAIN STATUS': ['clientTransferProhibited', 'ok'],
+                                   'NAME SERVER': ['ns1.dummy.net', 'ns2.dummy.net']})
+        self.detect(records)
+        rdap['entities'][0]['vcardArray'][1][0][3] = 'NEW REGISTRAR'
+        changed, _, changes = self.detect(parse_rdap_response(rdap))
+        self.assertEqual(changes, [Change(Change.MODIFIED, 'REGISTRAR', old='OLD REGISTRAR', new='NEW REGISTRAR')])
+
+
+if __name__ == '__main__':
+    unittest.main()
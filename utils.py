@@ -1,20 +1,29 @@
 import os
+import time
+import asyncio
 import logging
+import argparse
+import threading
+import http.cookiejar
 import requests
+import requests.adapters
+import urllib.parse
 import socket
 import redis
 
-def slack(message, slack_webhook_url):
+def slack(message, slack_webhook_url, timeout=10):
     """
     Function to send slack messages
     :param message: message to be sent
+    :param timeout: HTTP timeout in seconds
     :return: None
     """
     if not slack_webhook_url or not message:
         return None
     res = requests.post(
         slack_webhook_url,
-        json={"text": message + '\n'})
+        json={"text": message + '\n'},
+        timeout=timeout)
     return res
 
 def get_sensor_id():
@@ -54,11 +63,75 @@ def create_logger(name):
     logger.addHandler(ch)
     return logger
 
+_redis_pool = None
+_redis_pool_lock = threading.Lock()
+
+def get_redis_pool():
+    """ Return the process-wide Redis connection pool shared by all monitors """
+    global _redis_pool
+    with _redis_pool_lock:
+        if _redis_pool is None:
+            host = os.getenv("REDIS_HOST", "localhost")
+            port = os.getenv("REDIS_PORT", 6379)
+            db = os.getenv("REDIS_DB", 0)
+            max_connections = os.getenv("REDIS_MAX_CONNECTIONS")
+            if max_connections:
+                # checks wait up to REDIS_POOL_TIMEOUT seconds for a free connection instead of failing
+                timeout = float(os.getenv("REDIS_POOL_TIMEOUT", 20))
+                _redis_pool = redis.BlockingConnectionPool(host=host, port=port, db=db,
+                                                           max_connections=int(max_connections), timeout=timeout)
+            else:
+                _redis_pool = redis.ConnectionPool(host=host, port=port, db=db)
+        return _redis_pool
+
 def create_redis_client():
-    host = os.getenv("REDIS_HOST", "localhost")
-    port = os.getenv("REDIS_PORT", 6379)
-    db = os.getenv("REDIS_DB", 0)
-    return redis.Redis(host=host, port=port, db=db)
+    return redis.Redis(connection_pool=get_redis_pool())
+
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(url):
+    """ Return the keep-alive session shared by all requests to the host of the given url """
+    parsed = urllib.parse.urlsplit(url)
+    key = (parsed.scheme, parsed.netloc)
+    with _http_sessions_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            pool_size = int(os.getenv("HTTP_POOL_SIZE", 10))
+            session = requests.Session()
+            # probes stay stateless: no cookie is kept and replayed, nor leaks between the targets of a host
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount(f"{parsed.scheme}://", adapter)
+            _http_sessions[key] = session
+        return session
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket allowing `rate` operations per second with bursts of `burst` """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """ Take a token and return how many seconds the caller has to wait before using it """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    async def async_acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
 
 
 def str2bool(v):
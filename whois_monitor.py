@@ -1,72 +1,410 @@
 from base_monitor import BaseMonitor, MonitorFactory
-import whois21
+import os
+import re
 import json
+import time
+import datetime
+import asyncio
+import functools
+import threading
 from whois_servers import WHOIS_SERVERS
+from rdap_servers import RDAP_SERVERS
+from utils import TokenBucket, str2bool, get_http_session
 # avoid urllib3 debug logs
 import logging
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("urllib3").propagate = False
 
 
+# suffix -> WHOIS server index, built once and shared by all monitors
+WHOIS_SERVER_INDEX = {tld.lower().strip(): server for tld, server in WHOIS_SERVERS.items()}
+
+
+@functools.lru_cache(maxsize=65536)
+def find_whois_server(domain):
+    """ Find the WHOIS server of the longest known suffix of the given domain. """
+    labels = domain.lower().strip().strip('.').split('.')
+    # the first label is the registered name itself, unless the domain is a bare TLD
+    start = 1 if len(labels) > 1 else 0
+    for i in range(start, len(labels)):
+        server = WHOIS_SERVER_INDEX.get('.'.join(labels[i:]))
+        if server:
+            return server
+    return None
+
+
+def load_rdap_servers():
+    """ Return the bundled RDAP bootstrap table, or the IANA dns.json given by RDAP_BOOTSTRAP_FILE """
+    path = os.getenv("RDAP_BOOTSTRAP_FILE")
+    if not path:
+        return {tld.lower(): url for tld, url in RDAP_SERVERS.items()}
+    with open(path, 'r') as f:
+        bootstrap = json.load(f)
+    servers = {}
+    for tlds, urls in bootstrap.get('services', []):
+        url = next((u for u in urls if u.startswith('https://')), urls[0])
+        for tld in tlds:
+            servers[tld.lower()] = url
+    return servers
+
+
+RDAP_SERVER_INDEX = load_rdap_servers()
+
+
+@functools.lru_cache(maxsize=65536)
+def find_rdap_server(domain):
+    """ Find the RDAP base URL of the longest known suffix of the given domain. """
+    labels = domain.lower().strip().strip('.').split('.')
+    for i in range(1 if len(labels) > 1 else 0, len(labels)):
+        url = RDAP_SERVER_INDEX.get('.'.join(labels[i:]))
+        if url:
+            return url
+    return None
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_server_bucket(server):
+    """ Return the token bucket shared by all monitors querying the given WHOIS server """
+    with _buckets_lock:
+        bucket = _buckets.get(server)
+        if bucket is None:
+            bucket = TokenBucket(float(os.getenv("WHOIS_QPS", 1)), float(os.getenv("WHOIS_BURST", 5)))
+            _buckets[server] = bucket
+        return bucket
+
+
+def split_server(server, default_port=43):
+    """ Split a `host[:port]` WHOIS server """
+    host, sep, port = server.rpartition(':')
+    if sep and port.isdigit() and ']' not in port:
+        return host.strip('[]'), int(port)
+    return server, default_port
+
+
+async def whois_query(server, query, timeout=30):
+    """ Send query to a port-43 WHOIS server (`host[:port]`) and return its whole answer """
+    host, port = split_server(server)
+    await get_server_bucket(server).async_acquire()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=timeout)
+    try:
+        writer.write(query.encode('idna') + b'\r\n')
+        await asyncio.wait_for(writer.drain(), timeout=timeout)
+        data = await asyncio.wait_for(reader.read(-1), timeout=timeout)
+    finally:
+        writer.close()
+    return data
+
+
+WHOIS_FIELDS = frozenset([
+    'DOMAIN NAME',
+    'REGISTRY DOMAIN ID',
+    'REGISTRAR WHOIS SERVER',
+    'REGISTRAR URL',
+    'UPDATED DATE',
+    'CREATION DATE',
+    'REGISTRY EXPIRY DATE',
+    'REGISTRAR',
+    'REGISTRAR IANA ID',
+    'REGISTRAR ABUSE CONTACT EMAIL',
+    'REGISTRAR ABUSE CONTACT PHONE',
+    'DOMAIN STATUS',
+    'NAME SERVER',
+    'DNSSEC'])
+MULTI_VALUED_FIELDS = frozenset(['DOMAIN STATUS', 'NAME SERVER'])
+DATE_FIELDS = frozenset(['UPDATED DATE', 'CREATION DATE', 'REGISTRY EXPIRY DATE'])
+DATE_FORMATS = ('%Y-%m-%dT%H:%M:%S%z', '%Y-%m-%d %H:%M:%S%z', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d', '%d-%b-%Y', '%d.%m.%Y', '%Y.%m.%d', '%Y/%m/%d')
+
+# `<tracked field>: <value>` lines, in any case
+WHOIS_FIELDS_RE = re.compile(
+    rb'^[ \t]*(' + b'|'.join(re.escape(f.encode()) for f in sorted(WHOIS_FIELDS)) +
+    rb')[ \t]*:[ \t]*(.*?)[ \t\r]*$', re.IGNORECASE | re.MULTILINE)
+
+
+def normalize_date(value):
+    """ Return value as YYYY-MM-DDTHH:MM:SSZ (UTC), unchanged if it isn't a known date format """
+    text = re.sub(r'(\d{2}:\d{2}:\d{2})\.\d+', r'\1', value.strip())
+    text = re.sub(r'(Z| ?UTC)$', '+0000', text)
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        if date.tzinfo is not None:
+            date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return value.strip()
+
+
+def normalize_value(key, value):
+    value = value.strip()
+    if key in DATE_FIELDS:
+        return normalize_date(value)
+    if key == 'DOMAIN NAME':
+        # registries disagree on the case, RDAP answers in lower case
+        return value.upper().rstrip('.')
+    if key == 'NAME SERVER':
+        return value.lower().rstrip('.')
+    if key == 'DOMAIN STATUS':
+        # EPP status code, without the ICANN link that some servers append
+        return value.split()[0] if value else value
+    return value
+
+
+def add_field(fields, key, value):
+    """ Add a value of a tracked field, as a list like the records are cached: sorted values
+    for multi-valued fields, the first value only for the others """
+    value = normalize_value(key, value)
+    if not value:
+        return
+    if key in MULTI_VALUED_FIELDS:
+        values = fields.setdefault(key, [])
+        if value not in values:
+            values.append(value)
+            values.sort()
+    elif key not in fields:
+        fields[key] = [value]
+
+
+def parse_whois_response(raw):
+    """ Extract the normalized WHOIS_FIELDS from a raw answer in a single pass """
+    fields = {}
+    for match in WHOIS_FIELDS_RE.finditer(raw):
+        try:
+            value = match.group(2).decode('utf-8')
+        except UnicodeDecodeError:
+            value = match.group(2).decode('latin-1')
+        add_field(fields, match.group(1).decode().upper(), value)
+    return fields
+
+
+# RDAP statuses (RFC 8056) whose EPP code isn't the camel case of their words
+RDAP_STATUS_CODES = {'active': 'ok', 'associated': 'linked'}
+RDAP_EVENT_FIELDS = {'registration': 'CREATION DATE', 'expiration': 'REGISTRY EXPIRY DATE', 'last changed': 'UPDATED DATE'}
+
+
+def rdap_status_to_epp(status):
+    status = status.strip().lower()
+    if status in RDAP_STATUS_CODES:
+        return RDAP_STATUS_CODES[status]
+    words = status.split()
+    return words[0] + ''.join(w.capitalize() for w in words[1:]) if words else status
+
+
+def vcard_values(entity, name):
+    """ Values of the jCard properties `name` of an RDAP entity """
+    vcard = entity.get('vcardArray') or [None, []]
+    values = []
+    for prop in vcard[1]:
+        if prop and prop[0] == name and len(prop) > 3:
+            value = prop[3]
+            if isinstance(value, str):
+                values.append(value[4:] if value.startswith('tel:') else value)
+    return values
+
+
+def parse_rdap_response(data):
+    """ Map an RDAP domain object onto the normalized WHOIS_FIELDS """
+    fields = {}
+    for key, value in (('DOMAIN NAME', data.get('ldhName')), ('REGISTRY DOMAIN ID', data.get('handle')),
+                       ('REGISTRAR WHOIS SERVER', data.get('port43'))):
+        if value:
+            add_field(fields, key, value)
+    for event in data.get('events', []):
+        key = RDAP_EVENT_FIELDS.get(event.get('eventAction'))
+        if key and event.get('eventDate'):
+            add_field(fields, key, event['eventDate'])
+    for entity in data.get('entities', []):
+        if 'registrar' not in entity.get('roles', []):
+            continue
+        for value in vcard_values(entity, 'fn')[:1]:
+            add_field(fields, 'REGISTRAR', value)
+        for value in vcard_values(entity, 'url')[:1]:
+            add_field(fields, 'REGISTRAR URL', value)
+        for public_id in entity.get('publicIds', []):
+            if public_id.get('type') == 'IANA Registrar ID':
+                add_field(fields, 'REGISTRAR IANA ID', str(public_id.get('identifier', '')))
+        for contact in entity.get('entities', []):
+            if 'abuse' in contact.get('roles', []):
+                for value in vcard_values(contact, 'email')[:1]:
+                    add_field(fields, 'REGISTRAR ABUSE CONTACT EMAIL', value)
+                for value in vcard_values(contact, 'tel')[:1]:
+                    add_field(fields, 'REGISTRAR ABUSE CONTACT PHONE', value)
+    for status in data.get('status', []):
+        add_field(fields, 'DOMAIN STATUS', rdap_status_to_epp(status))
+    for nameserver in data.get('nameservers', []):
+        if nameserver.get('ldhName'):
+            add_field(fields, 'NAME SERVER', nameserver['ldhName'])
+    secure_dns = data.get('secureDNS')
+    if secure_dns is not None:
+        add_field(fields, 'DNSSEC', 'signedDelegation' if secure_dns.get('delegationSigned') else 'unsigned')
+    return fields
+
+
+def normalize_whois_fields(data):
+    """ Normalize parsed WHOIS data (from whois21 or a cached copy) like parse_whois_response """
+    fields = {}
+    for key, value in (data or {}).items():
+        key = key.upper()
+        if key not in WHOIS_FIELDS:
+            continue
+        for v in value if isinstance(value, list) else [value]:
+            add_field(fields, key, str(v))
+    return fields
+
 
 class WHOISMonitor(BaseMonitor):
-    """ Monitor a given domain. """
-    WHOIS_FIELDS = [
-        'DOMAIN NAME',
-        'REGISTRY DOMAIN ID',
-        'REGISTRAR WHOIS SERVER',
-        'REGISTRAR URL',
-        'UPDATED DATE',
-        'CREATION DATE',
-        'REGISTRY EXPIRY DATE',
-        'REGISTRAR',
-        'REGISTRAR IANA ID',
-        'REGISTRAR ABUSE CONTACT EMAIL',
-        'REGISTRAR ABUSE CONTACT PHONE',
-        'DOMAIN STATUS',
-        'NAME SERVER',
-        'DNSSEC']
+    """ Monitor a given domain.
+
+    The default `whois21` backend uses the whois21 library. The `native` backend
+    queries the WHOIS server with a built-in asyncio port-43 client, awaited
+    directly by the async engine, rate limited per server by a token bucket
+    shared by all the monitors of the process (WHOIS_QPS queries per second,
+    bursts of WHOIS_BURST). With `follow_referrals`, the registrar server given
+    by the registry is queried instead and remembered for the domain for
+    `referral_ttl` seconds.
+
+    The `rdap` backend asks the RDAP server of the TLD (or `rdap_server`) over a
+    keep-alive session shared by all the domains of the server. Answers are not
+    requested again while Cache-Control says they are fresh and are revalidated
+    with their ETag/Last-Modified, so unchanged registrations cost a 304. The
+    RDAP fields are mapped onto WHOIS_FIELDS, so records keep the same keys.
+    """
+    BACKENDS = ('native', 'whois21', 'rdap')
+    WHOIS_FIELDS = WHOIS_FIELDS
 
     def __init__(self, domain, whois_server=None, whois_timeout=30, 
-                 slack_webhook_url=None):
+                 slack_webhook_url=None, backend='whois21', follow_referrals=False, referral_ttl=86400,
+                 rdap_server=None):
         self.domain = domain.lower().strip()
         if not self.domain:
             raise ValueError("domain is required")
+        if backend not in self.BACKENDS:
+            raise ValueError(f"unknown backend {backend}")
         self.whois_timeout = whois_timeout
-        self.WHOIS_SERVERS = WHOIS_SERVERS
+        self.backend = backend
+        self.follow_referrals = follow_referrals
+        self.referral_ttl = referral_ttl
+        self.referral_server = None
+        self.referral_expiry = 0
+        self.rdap_server = rdap_server or find_rdap_server(self.domain)
+        self.validators = {}
+        self.fresh_until = 0
+        self.last_records = None
         if not whois_server or whois_server == "auto":
             self.whois_server = self._get_whois_server()
         else:
             self.whois_server = whois_server
-        BaseMonitor.__init__(self, slack_webhook_url=slack_webhook_url, domain=domain, whois_server=self.whois_server)
+        # registrar answers are kept apart from the registry ones
+        mode = {'follow_referrals': True} if follow_referrals else {}
+        BaseMonitor.__init__(self, slack_webhook_url=slack_webhook_url, domain=domain, whois_server=self.whois_server, **mode)
         self.logger.info(f"using WHOIS server {self.whois_server}")
 
     def _get_whois_server(self):
         """ Find WHOIS server for the given domain. """
-        for tld, server in self.WHOIS_SERVERS.items():
-            suffix = tld.lower().strip()
-            domain_suffix = self.domain.split('.', 1)[-1].lower().strip()
-            if domain_suffix == suffix:
-                self.whois_server = server
-                return self.whois_server
-        return None
-
-    def _whois_strip_data(self, data):
-        """ Extract WHOIS fields from WHOIS data. """
+        self.whois_server = find_whois_server(self.domain)
+        return self.whois_server
+
+    async def async_fetch(self):
+        """ Query the WHOIS server, or the registrar it refers to with follow_referrals """
+        if self.follow_referrals and self.referral_server and time.monotonic() < self.referral_expiry:
+            self.logger.info(f"fetching WHOIS data from {self.referral_server}")
+            try:
+                data = parse_whois_response(await whois_query(self.referral_server, self.domain, self.whois_timeout))
+                if data:
+                    return data
+            except (OSError, asyncio.TimeoutError) as e:
+                self.logger.warning(f"could not query {self.referral_server}: {e}")
+            self.logger.warning(f"no WHOIS data from {self.referral_server}, asking {self.whois_server} again")
+            self.referral_server = None
+        self.logger.info(f"fetching WHOIS data from {self.whois_server}")
+        data = parse_whois_response(await whois_query(self.whois_server, self.domain, self.whois_timeout))
+        referral = (data.get('REGISTRAR WHOIS SERVER') or [None])[0]
+        if referral:
+            referral = referral.lower().replace('whois://', '').rstrip('/')
+        if self.follow_referrals and referral and referral != self.whois_server.lower():
+            self.logger.info(f"following referral to {referral}")
+            try:
+                registrar_data = parse_whois_response(await whois_query(referral, self.domain, self.whois_timeout))
+            except (OSError, asyncio.TimeoutError) as e:
+                self.logger.warning(f"could not query {referral}: {e}")
+                registrar_data = None
+            if registrar_data:
+                self.referral_server = referral
+                self.referral_expiry = time.monotonic() + self.referral_ttl
+                return registrar_data
+        return data
+
+    async def async_fetch_new_records(self):
+        """ Fetch the given domain with the native backend """
+        if self.whois_server is None:
+            raise Exception("no WHOIS server found")
+        try:
+            data = await self.async_fetch()
+        except Exception as e:
+            self.logger.error(f"Error fetching {self.domain}: {e}")
+            raise e
         if not data:
-            return {}
-        fields = {}
-        for k, v in data.items():
-            if k in self.WHOIS_FIELDS:
-                fields[k] = v
-        return fields
+            raise ValueError("no WHOIS data found")
+        self.logger.debug(f"fetched {data}")
+        return data
+
+    def async_fetcher(self):
+        return self.async_fetch_new_records if self.backend == 'native' else None
+
+    def fetch_rdap(self):
+        """ Fetch the RDAP domain object, revalidating the last answer """
+        if self.last_records is not None and time.monotonic() < self.fresh_until:
+            self.logger.debug("RDAP answer still fresh")
+            return self.last_records
+        url = self.rdap_server.rstrip('/') + '/domain/' + self.domain
+        headers = {'Accept': 'application/rdap+json'}
+        if self.last_records is not None:
+            if 'etag' in self.validators:
+                headers['If-None-Match'] = self.validators['etag']
+            if 'last_modified' in self.validators:
+                headers['If-Modified-Since'] = self.validators['last_modified']
+        self.logger.info(f"fetching RDAP data from {url}")
+        response = get_http_session(url).get(url, headers=headers, timeout=self.whois_timeout)
+        max_age = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        no_cache = re.search(r'no-cache|no-store', response.headers.get('Cache-Control', ''))
+        self.fresh_until = time.monotonic() + int(max_age.group(1)) if max_age and not no_cache else 0
+        if response.status_code == 304 and self.last_records is not None:
+            self.logger.debug("RDAP answer not modified")
+            return self.last_records
+        response.raise_for_status()
+        records = parse_rdap_response(response.json())
+        self.validators = {}
+        if response.headers.get('ETag'):
+            self.validators['etag'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            self.validators['last_modified'] = response.headers['Last-Modified']
+        self.last_records = records
+        return records
 
     def fetch_new_records(self):
         """ Fetch the given domain. """
         try:
+            if self.backend == 'rdap':
+                if self.rdap_server is None:
+                    raise Exception("no RDAP server found")
+                data = self.fetch_rdap()
+                if not data:
+                    raise ValueError("no RDAP data found")
+                self.logger.debug(f"fetched {data}")
+                return data
+
+            if self.backend == 'native':
+                # a process of its own, the async engine awaits async_fetch_new_records instead
+                return asyncio.run(self.async_fetch_new_records())
+
             if self.whois_server is None:
                 raise Exception("no WHOIS server found")
 
+            # whois21 downloads its list of servers when imported
+            import whois21
             self.logger.info(f"fetching WHOIS data from {self.whois_server}")
             result = whois21.WHOIS(self.domain, servers=[self.whois_server], 
                                    use_rdap=False, timeout=self.whois_timeout)
@@ -74,7 +412,7 @@ class WHOISMonitor(BaseMonitor):
                 msg = f"Error fetching {self.domain}: {result.error}"
                 self.logger.error(msg)
                 return {}
-            data = self._whois_strip_data(result.whois_data)
+            data = normalize_whois_fields(result.whois_data)
             self.logger.debug(f"fetched {data}")
             return data
         except Exception as e:
@@ -83,11 +421,15 @@ class WHOISMonitor(BaseMonitor):
             raise e
 
     def get_cached_records(self):
-        """ Retrieve cached WHOIS data from Redis. """
-        data = self.redis_client.get(self.redis_key)
+        """ Retrieve cached WHOIS data from Redis.
+
+        Only read when the digest changed, records cached by previous versions are
+        normalized here so that the new format isn't reported as a change.
+        """
+        data = BaseMonitor.get_cached_records(self)
         if data is None or len(data) == 0:
             return json.dumps({})
-        data = self._whois_strip_data(json.loads(data))
+        data = normalize_whois_fields(json.loads(data))
         if not data:
             return json.dumps({})
         self.logger.debug(f"cached {data}")
@@ -102,13 +444,19 @@ class WHOISMonitorFactory(MonitorFactory):
         self.parser.add_argument('--domain', type=str, help='Domain to monitor', default=None, required=True)
         self.parser.add_argument("--whois_server", help="whois_server (default autodetected).", default=None)
         self.parser.add_argument("--whois_timeout", type=int, help="whois_timeout (default 30 seconds).", default=30)
+        self.parser.add_argument("--backend", choices=WHOISMonitor.BACKENDS, help="WHOIS client (default whois21)", default='whois21')
+        self.parser.add_argument("--rdap_server", help="RDAP base URL with --backend rdap (default from the bootstrap table)", default=None)
+        self.parser.add_argument("--follow_referrals", type=str2bool, help="query the registrar WHOIS server given by the registry (default False)", default=False)
         self.parser.add_argument("--slack_webhook_url", help="slack webhook url (default disabled)", default=None)
         self.parser.add_argument("--pause", help="pause time in seconds (default 60) between each check", type=int, default=300)
+        self.parser.add_argument("--metrics_port", type=int, help="serve Prometheus metrics on this port (default disabled)", default=None)
         self.args = self.parser.parse_args()
         self.slack_webhook_url = self.args.slack_webhook_url
         self.pause = self.args.pause
         self.monitor = self.monitor_class(self.args.domain, whois_server=self.args.whois_server, whois_timeout=self.args.whois_timeout, 
-                                          slack_webhook_url=self.slack_webhook_url)
+                                          slack_webhook_url=self.slack_webhook_url, backend=self.args.backend,
+                                          follow_referrals=self.args.follow_referrals, rdap_server=self.args.rdap_server)
+        self.start_metrics_server()
         self.monitor.serve_forever(pause=self.pause)
         return self.monitor
 
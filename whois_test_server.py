@@ -1,8 +1,9 @@
 import sys
-import socket
-import random
 import string
+import asyncio
 import logging
+import argparse
+import stand_in
 
 RESPONSE_SAMPLE = {
                 "Domain Name": "DUMMY.NET",
@@ -20,66 +21,85 @@ RESPONSE_SAMPLE = {
                 "DNSSEC": "unsigned"
 }
 
-def is_true():
-    return bool(random.randint(0, 4))
+# held open without answer for injected timeouts
+TIMEOUT_HOLD = 120
+
+logger = logging.getLogger("WHOISTestServer")
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+fh = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(fh)
+logger.addHandler(ch)
 
-def run_server(host='127.0.0.1', port=43):
-    # Create a TCP/IP socket
-    logger = logging.getLogger("WHOISTestServer")
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    fh = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    ch.setFormatter(fh)
-    logger.addHandler(ch)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
-    # Bind the socket to the address and port
-    server_address = (host, port)
-    logger.info(f"Starting up WHOIS server on {host} port {port}")
-    sock.bind(server_address)
-    
-    # Listen for incoming connections
-    sock.listen(1)
-    
-    while True:
-        # Wait for a connection
-        connection, client_address = sock.accept()
-        try:
-            logger.info(f"Connection from {client_address}")
 
-            # Receive the data in small chunks
-            data = connection.recv(1024)
-            logger.info(f"Received: {data.decode()}")
+def generate_response(rng):
+    """ Sample response with a few fields randomized and some fields missing """
+    random_keys = rng.sample(list(RESPONSE_SAMPLE.keys()), rng.randint(1, 3))
+    responses = {}
+    response = ""
+    for key, value in RESPONSE_SAMPLE.items():
+        if key in random_keys:
+            new_value = "".join(rng.sample(string.ascii_letters, rng.randint(1, 20)))
+        else:
+            new_value = value
+        if rng.randint(0, 4):
+            responses[key] = new_value
+    for key, new_value in responses.items():
+        response += f"{key}: {new_value}\n"
 
-            # Prepare and send a response
-            random_keys = random.sample(list(RESPONSE_SAMPLE.keys()), random.randint(1, 3))
-            responses = {}
-            response = ""
-            for key, value in RESPONSE_SAMPLE.items():
-                if key in random_keys:
-                    new_value = "".join(random.sample(string.ascii_letters, random.randint(1, 20)))
-                else:
-                    new_value = value
-                if is_true():
-                    responses[key] = new_value
-            for key, new_value in responses.items():
-                response += f"{key}: {new_value}\n"
+    for x in range(rng.randint(1, 4)):
+        if rng.randint(0, 4):
+            name_server = "".join(rng.sample(string.ascii_letters, rng.randint(1, 20)))
+            response += f"Name Server: {name_server}\n"
+    return response
 
-            for x in range(random.randint(1, 4)):
-                if is_true():
-                    name_server = "".join(random.sample(string.ascii_letters, random.randint(1, 20)))
-                    response += f"Name Server: {name_server}\n"
-            logger.info(f"Sending response")
-            connection.sendall(response.encode())
 
+class WHOISTestServer(object):
+    def __init__(self, behaviour=None):
+        self.behaviour = behaviour or stand_in.StandInBehaviour()
+
+    async def handle(self, reader, writer):
+        try:
+            # the query is a single line terminated by CRLF
+            data = await asyncio.wait_for(reader.readline(), timeout=30)
+            query = data.decode(errors='replace').strip()
+            logger.debug(f"Received: {query}")
+            fault, rng = self.behaviour.query(query.lower())
+            delay = self.behaviour.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            if fault == 'timeout':
+                await asyncio.sleep(TIMEOUT_HOLD)
+                return
+            if fault == 'error':
+                # registries usually just drop the connection
+                return
+            writer.write(generate_response(rng).encode())
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Connection error: {e}")
         finally:
-            # Clean up the connection
-            connection.close()
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def run_server(host='127.0.0.1', port=43, behaviour=None):
+    logger.info(f"Starting up WHOIS server on {host} port {port}")
+    asyncio.run(WHOISTestServer(behaviour).serve(host, port))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WHOIS test server")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=43)
+    stand_in.add_arguments(parser)
+    args = parser.parse_args()
+    logger.setLevel(args.log_level.upper())
     try:
-        run_server()
+        run_server(host=args.host, port=args.port, behaviour=stand_in.from_args(args))
     except KeyboardInterrupt:
         print("Shutting down WHOIS server")
     sys.exit(0)
-